@@ -0,0 +1,323 @@
+"""
+
+    Benchmarks of the recommenders at several dataset sizes.
+
+    Description: Every case times one stage of the recommenders on
+    synthetic datasets of increasing size, see `benchmarks/synthetic.py`.
+
+    - data_preprocessing: building the combined content features.
+    - content_model: one content-based recommendation.
+    - prediction_item: ranking the users of each favourite movie.
+    - pred_movies: the neighbourhood of three favourite movies.
+    - collab_model: one collaborative recommendation.
+
+    Each dataset lives in its own workspace directory with the layout of
+    the repository (`resources/data`, `resources/models`), so models built
+    for a benchmark never touch the real ones. Every case runs in a fresh
+    interpreter inside its workspace and reports the median wall time of
+    several runs after a warm-up, the peak resident memory of the process
+    and the peak of memory allocated by Python and numpy during one run.
+
+    Results are written as JSON and compared with a stored baseline;
+    cases which got slower or bigger than the tolerances allow are
+    reported as regressions and make the script exit with status 1.
+
+        python -m benchmarks.run --sizes small,medium
+        python -m benchmarks.run --save-baseline
+
+"""
+# Script dependencies
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import subprocess
+import numpy as np
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+workspace_dir = 'benchmarks/workspaces'
+results_path = 'benchmarks/results/latest.json'
+baseline_path = 'benchmarks/baseline.json'
+
+SIZES = {
+    'small': {'n_movies': 2000, 'n_users': 1000, 'n_ratings': 100000},
+    'medium': {'n_movies': 10000, 'n_users': 7000, 'n_ratings': 1000000},
+    'large': {'n_movies': 40000, 'n_users': 30000, 'n_ratings': 5000000},
+    # The shape of MovieLens 25M
+    'xlarge': {'n_movies': 62000, 'n_users': 162000, 'n_ratings': 25000000},
+}
+
+# Differences below these are noise, whatever their ratio to the baseline
+MIN_SECONDS = 0.002
+MIN_MB = 1.0
+
+# Latent factors of the synthetic collaborative model
+N_FACTORS = 100
+
+
+def _favourites(n=3, seed=42):
+    """Titles of `n` popular movies, as the app's users tend to pick."""
+    from utils.data_loader import load_imdb, load_movies, summarise_ratings
+
+    popular = summarise_ratings().movie_stats().nlargest(500, 'count')['movieId']
+    candidates = load_movies()[lambda df: df['movieId'].isin(popular)
+                               & df['movieId'].isin(load_imdb()['movieId'])]
+    rng = np.random.default_rng(seed)
+    return candidates['title'].iloc[rng.choice(len(candidates), n, replace=False)].tolist()
+
+
+def _data_preprocessing():
+    import glob
+    from recommenders.content_based import data_preprocessing
+    from utils.data_loader import cache_dir, load_imdb, load_movies
+
+    load_imdb(), load_movies()
+
+    def run():
+        # Without its cached table the features are rebuilt every time
+        for path in glob.glob(os.path.join(cache_dir, 'content_features-*')):
+            os.remove(path)
+        data_preprocessing()
+    return run
+
+
+def _content_model():
+    from recommenders.content_based import content_model, load_content_index
+
+    load_content_index()
+    movie_list = _favourites()
+    return lambda: content_model.uncached(movie_list, 10)
+
+
+def _prediction_item():
+    from recommenders.collaborative_based import prediction_item
+    from utils.catalog import load_catalog
+    from utils.data_loader import data_path
+
+    catalog = load_catalog(data_path('movies.csv'))
+    item_ids = [catalog.id_of_title(title) for title in _favourites()]
+    return lambda: [prediction_item(item_id, 10) for item_id in item_ids]
+
+
+def _pred_movies():
+    from recommenders.collaborative_based import pred_movies
+
+    movie_list = _favourites()
+    return lambda: pred_movies(movie_list)
+
+
+def _collab_model():
+    from recommenders.collaborative_based import collab_model
+    from utils.ratings_store import load_ratings_store
+
+    load_ratings_store()
+    movie_list = _favourites()
+    return lambda: collab_model.uncached(movie_list, 10)
+
+
+# Each case prepares its inputs and returns the function which is timed
+CASES = {
+    'data_preprocessing': _data_preprocessing,
+    'content_model': _content_model,
+    'prediction_item': _prediction_item,
+    'pred_movies': _pred_movies,
+    'collab_model': _collab_model,
+}
+
+
+def _peak_rss_mb():
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(case, repeats=5):
+    """Time one case in the current process, which must be in a workspace.
+
+    Returns
+    -------
+    dict
+        Median and fastest wall time in seconds, the peak resident memory
+        of the process before and after the case in MB, and the peak of
+        memory traced by `tracemalloc` during one run in MB.
+
+    """
+    import tracemalloc
+
+    rss_before = _peak_rss_mb()
+    run = CASES[case]()
+    run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    peak_rss = _peak_rss_mb()
+
+    tracemalloc.start()
+    run()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'case': case, 'repeats': repeats, 'seconds': float(np.median(times)),
+            'seconds_min': min(times), 'rss_before_mb': rss_before, 'peak_rss_mb': peak_rss,
+            'alloc_peak_mb': alloc_peak / 2 ** 20}
+
+
+def prepare_workspace(size, seed=42, root=workspace_dir):
+    """Create the workspace of a dataset size, unless it already exists.
+
+    The synthetic datasets are written to `resources/data` and random
+    latent factors for their users and movies are published to the factor
+    store, standing in for a trained collaborative model.
+
+    Returns
+    -------
+    str
+        Absolute path of the workspace.
+
+    """
+    from .synthetic import GENERATOR_VERSION, write_dataset
+
+    params = dict(SIZES[size], seed=seed)
+    path = os.path.abspath(os.path.join(root, f"{size}-{seed}"))
+    manifest_path = os.path.join(path, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            if json.load(file) == dict(params, generator=GENERATOR_VERSION):
+                return path
+    shutil.rmtree(path, ignore_errors=True)
+
+    data_path = os.path.join(path, 'resources', 'data')
+    write_dataset(data_path, **params)
+    _publish_random_factors(os.path.join(data_path, 'ratings.csv'),
+                            os.path.join(path, 'resources', 'models', 'factors'), seed)
+    with open(manifest_path, 'w') as file:
+        json.dump(dict(params, generator=GENERATOR_VERSION), file)
+    return path
+
+
+def _publish_random_factors(ratings_path, root, seed):
+    import pandas as pd
+    from recommenders.factors import FactorModel, publish_factors
+
+    user_ids = item_ids = np.empty(0, dtype=np.int64)
+    for chunk in pd.read_csv(ratings_path, usecols=['userId', 'movieId'], chunksize=1000000):
+        user_ids = np.union1d(user_ids, chunk['userId'])
+        item_ids = np.union1d(item_ids, chunk['movieId'])
+    rng = np.random.default_rng(seed)
+    # Scoring costs the same whatever the values, so they need not be trained
+    model = FactorModel(rng.normal(0, 0.1, (len(user_ids), N_FACTORS)),
+                        rng.normal(0, 0.1, (len(item_ids), N_FACTORS)),
+                        rng.normal(0, 0.3, len(user_ids)), rng.normal(0, 0.3, len(item_ids)),
+                        3.5, user_ids, item_ids)
+    publish_factors(model, root, source='synthetic')
+
+
+def run_case(case, size, seed=42, repeats=5):
+    """Measure one case on one dataset size in a fresh interpreter."""
+    workspace = prepare_workspace(size, seed)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [repo_root] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    env.pop('RECOMMENDER_DATA_DIR', None)
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--child', case,
+                             '--repeats', str(repeats)],
+                            cwd=workspace, env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"Benchmark {case} on {size} failed:\n{output.stderr}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    return dict(result, size=size, **SIZES[size])
+
+
+def compare(results, baseline, time_tolerance=0.2, memory_tolerance=0.1):
+    """Find the cases which regressed against a baseline.
+
+    Parameters
+    ----------
+    results, baseline : list (dict)
+        Results of `run_case`.
+    time_tolerance, memory_tolerance : float
+        Allowed relative growth of the wall time and of the memory peaks.
+
+    Returns
+    -------
+    list (dict)
+        One entry per regressed metric, with the baseline and current
+        values and their ratio.
+
+    """
+    previous = {(row['case'], row['size']): row for row in baseline}
+    regressions = []
+    for row in results:
+        before = previous.get((row['case'], row['size']))
+        if before is None:
+            continue
+        for metric, tolerance, floor in [('seconds', time_tolerance, MIN_SECONDS),
+                                         ('peak_rss_mb', memory_tolerance, MIN_MB),
+                                         ('alloc_peak_mb', memory_tolerance, MIN_MB)]:
+            if (row[metric] > before[metric] * (1 + tolerance)
+                    and row[metric] - before[metric] > floor):
+                regressions.append({'case': row['case'], 'size': row['size'], 'metric': metric,
+                                    'baseline': before[metric], 'current': row[metric],
+                                    'ratio': row[metric] / before[metric]})
+    return regressions
+
+
+def _write_json(path, payload):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(payload, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the recommenders at several sizes.")
+    parser.add_argument('--sizes', default='small,medium',
+                        help=f"Comma separated sizes out of {', '.join(SIZES)}.")
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help="Comma separated cases to run.")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=results_path)
+    parser.add_argument('--baseline', default=baseline_path)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Store the results as the new baseline instead of comparing.")
+    parser.add_argument('--time-tolerance', type=float, default=0.2)
+    parser.add_argument('--memory-tolerance', type=float, default=0.1)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.repeats)))
+        sys.exit(0)
+
+    results = []
+    for size in args.sizes.split(','):
+        for case in args.cases.split(','):
+            row = run_case(case, size, args.seed, args.repeats)
+            results.append(row)
+            print(f"{case:>18} {size:>6}: {row['seconds'] * 1000:9.1f} ms, "
+                  f"peak RSS {row['peak_rss_mb']:7.1f} MB, "
+                  f"allocated {row['alloc_peak_mb']:7.1f} MB")
+    report = {'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+              'python': platform.python_version(), 'machine': platform.machine(),
+              'seed': args.seed, 'results': results}
+    _write_json(args.output, report)
+
+    if args.save_baseline:
+        _write_json(args.baseline, report)
+        print(f"Saved the baseline to: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.time_tolerance,
+                                  args.memory_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['case']} {regression['size']} {regression['metric']}: "
+                  f"{regression['baseline']:.3f} -> {regression['current']:.3f} "
+                  f"(x{regression['ratio']:.2f})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
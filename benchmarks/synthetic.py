@@ -0,0 +1,287 @@
+"""
+
+    Synthetic MovieLens-scale datasets for benchmarks and scaling tests.
+
+    Description: Writes `movies.csv`, `ratings.csv` and `imdb_data.csv`
+    with the columns and value formats of the real files, at any size up
+    to tens of millions of ratings. The output only depends on the sizes
+    and the seed.
+
+    - Movie popularity follows a Zipf law, so a few blockbusters collect
+      most ratings and most movies have a handful.
+    - User activity is log-normal with at least 20 ratings per user, as
+      in MovieLens. Every user favours one genre and rates its movies
+      more often.
+    - Genres are drawn with their MovieLens frequencies, one to four per
+      movie. Cast, directors and plot keywords come from Zipf-distributed
+      vocabularies, and keywords lean towards the movie's first genre.
+    - Ratings are half stars around a per-movie quality and per-user
+      bias, in whole stars before half stars were introduced in 2003,
+      and never earlier than the movie's release.
+
+    Ratings are generated and written a chunk of users at a time, so
+    memory depends on the catalog and `chunk_rows`, not on the number of
+    ratings.
+
+        python -m benchmarks.synthetic resources/data --ratings 25000000
+
+"""
+# Script dependencies
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+# MovieLens 25M genre frequencies
+GENRE_WEIGHTS = {
+    'Drama': 25606, 'Comedy': 16870, 'Thriller': 8654, 'Romance': 7719, 'Action': 7348,
+    'Horror': 5989, 'Documentary': 5605, 'Crime': 5319, 'Adventure': 4145, 'Sci-Fi': 3595,
+    'Children': 2935, 'Animation': 2929, 'Mystery': 2925, 'Fantasy': 2731, 'War': 1874,
+    'Western': 1399, 'Musical': 1054, 'Film-Noir': 353, 'IMAX': 195,
+}
+GENRES = list(GENRE_WEIGHTS)
+NO_GENRES = '(no genres listed)'
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'vo', 'shi', 'an', 'bel', 'dor', 'el', 'fin',
+             'gar', 'hal', 'is', 'jo', 'kes', 'lan', 'mor', 'nel', 'or', 'pre', 'quin', 'ros',
+             'sa', 'tor', 'ul', 'ven', 'wil', 'yar']
+
+# Bumped whenever the same seed starts producing different data
+GENERATOR_VERSION = 1
+
+# Ratings before this date (18 February 2003) are whole stars
+HALF_STARS_FROM = 1045526400
+FIRST_RATING, LAST_RATING = 789652009, 1574327703
+
+
+def _word(i):
+    """A pronounceable word, different for every non-negative integer."""
+    syllables = []
+    while True:
+        i, digit = divmod(i, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+        if i == 0:
+            break
+        i -= 1
+    return ''.join(syllables)
+
+
+def _zipf(n, exponent, rng):
+    """Zipf probabilities of `n` outcomes, in a random order."""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+
+def _choice(rng, p, size):
+    """Draw indexes with probabilities `p` through the inverse CDF."""
+    cdf = np.cumsum(p)
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1], side='right'), len(p) - 1)
+
+
+class _Catalog:
+    """Attributes of every synthetic movie, shared by the three files."""
+
+    def __init__(self, n_movies, rng):
+        self.n = n_movies
+        # MovieLens ids have gaps where movies were removed
+        self.movie_ids = np.cumsum(rng.geometric(0.7, n_movies))
+        # More movies come out every year
+        years = np.arange(1915, 2020)
+        year_p = np.exp((years - years[-1]) / 25)
+        self.years = rng.choice(years, n_movies, p=year_p / year_p.sum())
+        genre_p = np.array(list(GENRE_WEIGHTS.values()), dtype=float)
+        self.genre_p = genre_p / genre_p.sum()
+        self.primary_genre = _choice(rng, self.genre_p, n_movies)
+        self.n_genres = rng.choice([1, 2, 3, 4], n_movies, p=[0.4, 0.33, 0.18, 0.09])
+        self.popularity = _zipf(n_movies, 1.0, rng)
+        self.quality = rng.normal(3.4, 0.45, n_movies)
+        self.release = ((self.years - 1970) * 365.25 * 86400).astype(np.int64)
+        # Title words are distinct numbers, which keeps titles unique
+        self.title_words = rng.permutation(n_movies * 4)[:n_movies]
+
+    def genres(self, i, rng):
+        if rng.random() < 0.005:
+            return NO_GENRES
+        p = self.genre_p.copy()
+        p[self.primary_genre[i]] = 0
+        others = rng.choice(len(GENRES), self.n_genres[i] - 1, replace=False, p=p / p.sum())
+        return '|'.join(sorted(GENRES[g] for g in [self.primary_genre[i], *others]))
+
+    def title(self, i, rng):
+        words = _word(self.title_words[i]).capitalize()
+        if rng.random() < 0.3:
+            words = f"The {words}"
+        elif rng.random() < 0.2:
+            words = f"{words} {_word(rng.integers(0, 400)).capitalize()}"
+        return f"{words} ({self.years[i]})"
+
+
+def _name(i):
+    last, first = divmod(i, 400)
+    return f"{_word(first + 30).capitalize()} {_word(last + 900).capitalize()}"
+
+
+def _write_movies(path, catalog, rng, imdb_coverage, chunk_movies=20000):
+    n = catalog.n
+    n_actors, n_directors = max(n * 2, 50), max(n // 4, 10)
+    n_keywords = max(n // 2, 40)
+    actor_p, director_p = _zipf(n_actors, 0.9, rng), _zipf(n_directors, 0.7, rng)
+    keyword_p = _zipf(n_keywords, 1.0, rng)
+    # Every genre favours its own slice of the keyword vocabulary
+    genre_keywords = rng.integers(0, n_keywords, (len(GENRES), 60))
+
+    for start in range(0, n, chunk_movies):
+        rows = range(start, min(start + chunk_movies, n))
+        movies = pd.DataFrame({'movieId': catalog.movie_ids[rows.start:rows.stop],
+                               'title': [catalog.title(i, rng) for i in rows],
+                               'genres': [catalog.genres(i, rng) for i in rows]})
+        movies.to_csv(os.path.join(path, 'movies.csv'), index=False,
+                      mode='w' if start == 0 else 'a', header=start == 0)
+
+        has_imdb = np.array([i for i in rows if rng.random() < imdb_coverage], dtype=np.int64)
+        cast_sizes = rng.integers(3, 9, len(has_imdb))
+        actors = np.split(_choice(rng, actor_p, cast_sizes.sum()), np.cumsum(cast_sizes)[:-1])
+        keyword_sizes = rng.integers(2, 7, len(has_imdb))
+        keywords = np.split(_choice(rng, keyword_p, keyword_sizes.sum()),
+                            np.cumsum(keyword_sizes)[:-1])
+        for words, i in zip(keywords, has_imdb):
+            themed = rng.random(len(words)) < 0.5
+            words[themed] = rng.choice(genre_keywords[catalog.primary_genre[i]], themed.sum())
+        budgets = np.where(rng.random(len(has_imdb)) < 0.6, 0,
+                           np.round(rng.lognormal(16.5, 1.2, len(has_imdb)), -5).astype(np.int64))
+        runtimes = rng.normal(100, 20, len(has_imdb)).round().clip(40, 240)
+        runtimes[rng.random(len(has_imdb)) < 0.05] = np.nan
+        imdb = pd.DataFrame({
+            'movieId': catalog.movie_ids[has_imdb],
+            'title_cast': ['|'.join(_name(a) for a in cast) for cast in actors],
+            'director': [_name(d + n_actors) for d in _choice(rng, director_p, len(has_imdb))],
+            'runtime': runtimes,
+            'budget': [f"${b:,}" if b else '' for b in budgets],
+            'plot_keywords': ['|'.join(_word(k + 2000) for k in words) for words in keywords]})
+        imdb.to_csv(os.path.join(path, 'imdb_data.csv'), index=False,
+                    mode='w' if start == 0 else 'a', header=start == 0)
+
+
+def _user_activity(n_users, n_ratings, n_movies, rng):
+    """Number of ratings of every user, summing to about `n_ratings`."""
+    least = min(20, n_ratings // n_users, n_movies // 2)
+    weights = rng.lognormal(0, 1.2, n_users)
+    counts = least + np.floor((n_ratings - least * n_users) * weights / weights.sum())
+    return np.minimum(counts, max(n_movies // 2, 1)).astype(np.int64)
+
+
+def _distinct_movies(counts, tastes, catalog, cdfs, rng, max_rounds=10):
+    """Draw `counts` distinct movies per user, grouped by user."""
+    owner = movies = np.empty(0, dtype=np.int64)
+    for attempt in range(max_rounds):
+        deficit = counts - np.bincount(owner, minlength=len(counts))
+        users = np.flatnonzero(deficit > 0)
+        if not len(users):
+            break
+        # Popular movies are drawn more than once, so every round draws more spares
+        draws = deficit[users] + np.ceil(deficit[users] * 0.25 * 2 ** attempt).astype(np.int64) + 5
+        new_owner = np.repeat(users, draws)
+        new_movies = np.empty(len(new_owner), dtype=np.int64)
+        for taste in np.unique(tastes[users]):
+            mask = tastes[new_owner] == taste
+            cdf = cdfs[taste]
+            new_movies[mask] = np.minimum(np.searchsorted(cdf, rng.random(mask.sum()) * cdf[-1],
+                                                          side='right'), catalog.n - 1)
+        owner, movies = np.concatenate([owner, new_owner]), np.concatenate([movies, new_movies])
+
+        # The first draws of distinct movies, up to the user's count
+        _, first = np.unique(owner * catalog.n + movies, return_index=True)
+        first.sort()
+        first = first[np.argsort(owner[first], kind='stable')]
+        owner, movies = owner[first], movies[first]
+        keep = np.arange(len(owner)) - np.searchsorted(owner, owner) < counts[owner]
+        owner, movies = owner[keep], movies[keep]
+    return owner, movies
+
+
+def _ratings_chunk(user_ids, counts, tastes, catalog, cdfs, rng):
+    """Ratings of a chunk of users, sorted by user and movie."""
+    owner, movies = _distinct_movies(counts, tastes, catalog, cdfs, rng)
+
+    # Every user rates within an active period of their own
+    starts = rng.integers(FIRST_RATING, LAST_RATING, len(user_ids))
+    spans = np.minimum(rng.exponential(200 * 86400, len(user_ids)).astype(np.int64),
+                       LAST_RATING - starts)
+    timestamps = starts[owner] + (rng.random(len(owner)) * spans[owner]).astype(np.int64)
+    timestamps = np.minimum(np.maximum(timestamps, catalog.release[movies]), LAST_RATING)
+
+    biases = rng.normal(0.1, 0.4, len(user_ids))
+    scores = catalog.quality[movies] + biases[owner] + rng.normal(0, 0.8, len(owner))
+    ratings = np.where(timestamps < HALF_STARS_FROM, np.round(scores).clip(1, 5),
+                       (np.round(scores * 2) / 2).clip(0.5, 5))
+
+    order = np.lexsort((catalog.movie_ids[movies], owner))
+    return pd.DataFrame({'userId': user_ids[owner[order]],
+                         'movieId': catalog.movie_ids[movies[order]],
+                         'rating': ratings[order],
+                         'timestamp': timestamps[order]})
+
+
+def write_dataset(path, n_movies, n_users, n_ratings, seed=42, imdb_coverage=0.9,
+                  chunk_rows=1000000):
+    """Write a synthetic copy of the three datasets to the directory `path`.
+
+    Parameters
+    ----------
+    path : str
+        Directory to write the CSV files to.
+    n_movies, n_users : int
+        Size of the catalog and number of users.
+    n_ratings : int
+        Approximate number of ratings. Heavy users are capped at half of
+        the catalog, so very dense datasets come out a little smaller.
+    seed : int
+        Seed of the random generator.
+    imdb_coverage : float
+        Share of the movies with a row in `imdb_data.csv`.
+    chunk_rows : int
+        Ratings generated and written at once.
+
+    Returns
+    -------
+    int
+        Number of ratings written.
+
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    catalog = _Catalog(n_movies, rng)
+    _write_movies(path, catalog, rng, imdb_coverage)
+
+    # Users pick from the popularity curve, boosted for their favourite genre
+    cdfs = [np.cumsum(catalog.popularity * np.where(catalog.primary_genre == genre, 4.0, 1.0))
+            for genre in range(len(GENRES))]
+    counts = _user_activity(n_users, n_ratings, n_movies, rng)
+    tastes = _choice(rng, catalog.genre_p, n_users)
+    user_ids = np.arange(1, n_users + 1)
+
+    written, start = 0, 0
+    with open(os.path.join(path, 'ratings.csv'), 'w', newline='') as file:
+        while start < n_users:
+            stop = start + max(int(np.searchsorted(np.cumsum(counts[start:]), chunk_rows)), 1)
+            chunk = _ratings_chunk(user_ids[start:stop], counts[start:stop], tastes[start:stop],
+                                   catalog, cdfs, rng)
+            chunk.to_csv(file, index=False, header=start == 0)
+            written += len(chunk)
+            start = stop
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic MovieLens-style datasets.")
+    parser.add_argument('path', help="Directory to write the CSV files to.")
+    parser.add_argument('--movies', type=int, default=62000)
+    parser.add_argument('--users', type=int, default=162000)
+    parser.add_argument('--ratings', type=int, default=25000000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk-rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    written = write_dataset(args.path, args.movies, args.users, args.ratings, args.seed,
+                            chunk_rows=args.chunk_rows)
+    print(f"Wrote {args.movies} movies and {written} ratings to: {args.path}")
@@ -30,8 +30,8 @@ import streamlit as st
 
 # Data handling dependencies
 import pandas as pd
-import numpy as np
 import codecs
+import time
 #Visuals
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -42,42 +42,30 @@ init_notebook_mode(connected=True)
 import plotly.express as px
 
 # Custom Libraries
-from utils.data_loader import load_movie_titles
+from utils.data_loader import load_movie_titles, data_path
+from utils.eda import rating_histogram, title_ratings, ratings_per_year, genre_counts, release_year_counts
 from recommenders.collaborative_based import collab_model
 from recommenders.content_based import content_model
+from recommenders.jobs import get_job_pool
+from recommenders.result_cache import favourites_key
+from utils import tracing
 
 # Data Loading
-title_list = load_movie_titles('resources/data/movies.csv')
-movies = pd.read_csv('resources/data/movies.csv')
-train = pd.read_csv('resources/data/ratings.csv')
-df_imdb = pd.read_csv('resources/data/imdb_data.csv')
-
-# Merging the train and the movies
-df_merge1 = train.merge(movies, on = 'movieId')
-from datetime import datetime
-# Convert timestamp to year column representing the year the rating was made on merged dataframe
-df_merge1['rating_year'] = df_merge1['timestamp'].apply(lambda timestamp: datetime.fromtimestamp(timestamp).year)
-df_merge1.drop('timestamp', axis=1, inplace=True)
-
-# -------------- Create a Figure that shows us that shows us how the Ratigs are distriuted. ----------------#
-# Get the data
-data = df_merge1['rating'].value_counts().sort_index(ascending=False)
-
-ratings_df = pd.DataFrame()
-ratings_df['Mean_Rating'] = df_merge1.groupby('title')['rating'].mean().values
-ratings_df['Num_Ratings'] = df_merge1.groupby('title')['rating'].count().values
-
-genre_df = pd.DataFrame(df_merge1['genres'].str.split('|').tolist(), index=df_merge1['movieId']).stack()
-genre_df = genre_df.reset_index([0, 'movieId'])
-genre_df.columns = ['movieId', 'Genre']
+# Each dataset is read once per process and shared with the recommenders
+title_list = load_movie_titles(data_path('movies.csv'))
+# Created once per process, loading the models in the background
+job_pool = get_job_pool()
+
+# The summary tables behind the EDA charts are built when a chart is first opened
 
 def make_bar_chart(dataset, attribute, bar_color='#3498db', edge_color='#2980b9', title='Title', xlab='X', ylab='Y', sort_index=False):
+    # dataset holds one row per value of attribute, with its count
     if sort_index == False:
-        xs = dataset[attribute].value_counts().index
-        ys = dataset[attribute].value_counts().values
+        dataset = dataset.sort_values('count', ascending=False)
     else:
-        xs = dataset[attribute].value_counts().sort_index().index
-        ys = dataset[attribute].value_counts().sort_index().values
+        dataset = dataset.sort_values(attribute)
+    xs = dataset[attribute].values
+    ys = dataset['count'].values
 
 
     fig, ax = plt.subplots(figsize=(14, 7))
@@ -90,58 +78,78 @@ def make_bar_chart(dataset, attribute, bar_color='#3498db', edge_color='#2980b9'
     plt.bar(x=xs, height=ys, color=bar_color, edgecolor=edge_color, linewidth=2)
     plt.xticks(rotation=45)
 
- # Merging the merge data earlier on with the df_imbd
-df_merge3 = df_merge1.merge(df_imdb, on = "movieId" )
-
-num_ratings = pd.DataFrame(df_merge3.groupby('movieId').count()['rating']).reset_index()
-df_merge3 = pd.merge(left=df_merge3, right=num_ratings, on='movieId')
-df_merge3.rename(columns={'rating_x': 'rating', 'rating_y': 'numRatings'}, inplace=True)
-
-# pre_process the budget column
-
-# remove commas
-df_merge3['budget'] = df_merge3['budget'].str.replace(',', '')
-# remove currency signs like "$" and "GBP"
-df_merge3['budget'] = df_merge3['budget'].str.extract('(\d+)', expand=False)
-#convert the feature into a float
-df_merge3['budget'] = df_merge3['budget'].astype(float)
-#remove nan values and replacing with 0
-df_merge3['budget'] = df_merge3['budget'].replace(np.nan,0)
-#convert the feature into an integer
-df_merge3['budget'] = df_merge3['budget'].astype(int)
-
-df_merge3['release_year'] = df_merge3.title.str.extract('(\(\d\d\d\d\))', expand=False)
-df_merge3['release_year'] = df_merge3.release_year.str.extract('(\d\d\d\d)', expand=False)
-
-data_1= df_merge3.drop_duplicates('movieId')
-
-# Movies published by year:
-
-years = []
-
-for title in df_merge3['title']:
-    year_subset = title[-5:-1]
-    try: years.append(int(year_subset))
-    except: years.append(9999)
-
-df_merge3['moviePubYear'] = years
-print('The Number of Movies Published each year:',len(df_merge3[df_merge3['moviePubYear'] == 9999]))
-
-def make_histogram(dataset, attribute, bins=25, bar_color='#3498db', edge_color='#2980b9', title='Title', xlab='X', ylab='Y', sort_index=False):
-    if attribute == 'moviePubYear':
-        dataset = dataset[dataset['moviePubYear'] != 9999]
-
-    fig, ax = plt.subplots(figsize=(14, 7))
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.set_title(title, fontsize=24, pad=20)
-    ax.set_xlabel(xlab, fontsize=16, labelpad=20)
-    #ax.set_yticklabels([yticklabels(item, 'M') for item in ax.get_yticks()])
-    ax.set_ylabel(ylab, fontsize=16, labelpad=20)
-
-    plt.hist(dataset[attribute], bins=bins, color=bar_color, ec=edge_color, linewidth=2)
-
-    plt.xticks(rotation=45)
+def show_recommendations(algorithm, recommend, fav_movies, clicked):
+    """Compute recommendations in the background and show their progress.
+
+    The job is kept in the session state and polled by rerunning the
+    script, so the session stays responsive while it runs. A job for
+    other favourites or another algorithm is released, which cancels it
+    unless another session is waiting for the same result.
+    """
+    job = st.session_state.get('recommend_job')
+    if job is not None and job.key != (algorithm, favourites_key(fav_movies), 10):
+        job_pool.release(job)
+        job = st.session_state['recommend_job'] = None
+    if clicked and job is None:
+        job = st.session_state['recommend_job'] = job_pool.submit(algorithm, recommend,
+                                                                  fav_movies, top_n=10)
+    if job is None:
+        return
+
+    if not job.done():
+        st.progress(int(job.progress * 100))
+        st.write(f"Crunching the numbers: {job.stage} ({job.elapsed:.1f}s)")
+        time.sleep(0.2)
+        rerun = getattr(st, 'rerun', None) or st.experimental_rerun
+        rerun()
+        return
+    try:
+        top_recommendations = job.result()
+        st.title("We think you'll like:")
+        for i,j in enumerate(top_recommendations):
+            st.subheader(str(i+1)+'. '+j)
+    except:
+        st.error("Oops! Looks like this algorithm does't work.\
+                  We'll need to fix it!")
+
+
+def show_diagnostics():
+    """Show recent request traces and the percentiles of every stage.
+
+    Recording is switched for the whole process, so it covers the
+    requests of every session. See `utils/tracing.py`.
+    """
+    st.title("Diagnostics")
+    record = st.sidebar.checkbox("Record traces", value=tracing.enabled)
+    memory = st.sidebar.checkbox("Trace memory allocations (slower)", value=tracing.trace_memory)
+    if record and (not tracing.enabled or memory != tracing.trace_memory):
+        tracing.enable(memory=memory)
+    elif not record and tracing.enabled:
+        tracing.disable()
+
+    traces = tracing.recent_traces()
+    if not traces:
+        st.info("No traces yet. Switch on recording in the sidebar and ask for some recommendations.")
+        return
+    st.write("### Stage percentiles")
+    st.markdown("Durations in milliseconds over the last {} traces. The empty stage is the whole "
+                "request.".format(len(traces)))
+    st.dataframe(pd.DataFrame(tracing.summary(traces)).round(2))
+
+    st.write("### Recent requests")
+    st.dataframe(pd.DataFrame([{
+        'started': pd.to_datetime(record['started'], unit='s'),
+        'request': record['name'],
+        'total_ms': round(record['seconds'] * 1000, 1),
+        'error': record['error'],
+        'stages': ', '.join("{} {:.1f} ms".format(stage['name'], stage['seconds'] * 1000)
+                            for stage in record['spans']),
+    } for record in traces[:50]]))
+
+    st.download_button("Export traces as JSON lines", tracing.to_jsonl(),
+                       file_name='traces.jsonl', mime='application/json')
+    if st.button("Clear traces"):
+        tracing.clear()
 
 
 # App declaration
@@ -149,7 +157,8 @@ def main():
 
     # DO NOT REMOVE the 'Recommender System' option below, however,
     # you are welcome to add more options to enrich your app.
-    page_options = ["Recommender System", "Movie Data Analysis", "Box Office Trailers", "Solution Overview", "About Us"]
+    page_options = ["Recommender System", "Movie Data Analysis", "Box Office Trailers", "Solution Overview", "About Us",
+                    "Diagnostics"]
 
     # -------------------------------------------------------------------
     # ----------- !! THIS CODE MUST NOT BE ALTERED !! -------------------
@@ -173,32 +182,15 @@ def main():
         fav_movies = [movie_1,movie_2,movie_3]
 
         # Perform top-10 movie recommendation generation
+        # Jobs run on the shared pool, see `show_recommendations`
         if sys == 'Content Based Filtering':
-            if st.button("Recommend"):
-                try:
-                    with st.spinner('Crunching the numbers...'):
-                        top_recommendations = content_model(movie_list=fav_movies,
-                                                            top_n=10)
-                    st.title("We think you'll like:")
-                    for i,j in enumerate(top_recommendations):
-                        st.subheader(str(i+1)+'. '+j)
-                except:
-                    st.error("Oops! Looks like this algorithm does't work.\
-                              We'll need to fix it!")
+            clicked = st.button("Recommend")
+            show_recommendations('content', content_model, fav_movies, clicked)
 
 
         if sys == 'Collaborative Based Filtering':
-            if st.button("Recommend"):
-                try:
-                    with st.spinner('Crunching the numbers...'):
-                        top_recommendations = collab_model(movie_list=fav_movies,
-                                                           top_n=10)
-                    st.title("We think you'll like:")
-                    for i,j in enumerate(top_recommendations):
-                        st.subheader(str(i+1)+'. '+j)
-                except:
-                    st.error("Oops! Looks like this algorithm does't work.\
-                              We'll need to fix it!")
+            clicked = st.button("Recommend")
+            show_recommendations('collab', collab_model, fav_movies, clicked)
 
 
     # -------------------------------------------------------------------
@@ -216,7 +208,7 @@ def main():
         if st.sidebar.checkbox("Insights on Ratings"):
             st.markdown("### What would you like to know?")
             if st.checkbox("How are the ratings distributed?"):
-                f = px.histogram(df_merge1["rating"], x="rating", nbins=10, title="The Distribution of the Movie Ratings")
+                f = px.bar(rating_histogram(), x="rating", y="count", title="The Distribution of the Movie Ratings")
                 f.update_xaxes(title="Ratings")
                 f.update_yaxes(title="Number of Movies per rating")
                 st.plotly_chart(f)
@@ -237,7 +229,8 @@ def main():
                 ax.set_title('Average movie rating sentiment change as more people rate movies', fontsize=24, pad=20)
                 ax.set_xlabel('Rating', fontsize=16, labelpad=20)
                 ax.set_ylabel('Number of Ratings', fontsize=16, labelpad=20)
-                plt.scatter(ratings_df['Mean_Rating'], ratings_df['Num_Ratings'], alpha=0.5, color='green')
+                ratings_df = title_ratings()
+                plt.scatter(ratings_df['mean_rating'], ratings_df['num_ratings'], alpha=0.5, color='green')
                 st.pyplot(fig)
                 st.markdown("The more a movie gets more ratings it’s average ratings tends to increase."
                             " This is because the more people that watch the movie the more ratings it gets and "
@@ -248,7 +241,7 @@ def main():
 
             if st.checkbox("How many users rated movies over the years?"):
                 fig, ax = plt.subplots(1, 1, figsize=(12, 6))
-                ax1 = df_merge1.groupby('rating_year')['rating'].count().plot(kind='bar', title='Ratings by year')
+                ax1 = ratings_per_year().set_index('year')['count'].plot(kind='bar', title='Ratings by year')
                 st.write(fig)
                 st.markdown("This shows that people tend to give lower ratings in recent years, "
                             "this may be because of the availability of a variety of movies in recent years, "
@@ -290,7 +283,7 @@ def main():
                 st.markdown("### How would you like to view this?")
                 if st.checkbox("Bar Chart"):
                     st.set_option('deprecation.showPyplotGlobalUse', False)
-                    fig = make_bar_chart(genre_df, 'Genre', title='Most Popular Movie Genres', xlab='Genre', ylab='Counts')
+                    fig = make_bar_chart(genre_counts(), 'genre', title='Most Popular Movie Genres', xlab='Genre', ylab='Counts')
                     st.pyplot(fig)
                     st.markdown("Drama and comedy were the earliest genres of cinema, and they're still the most "
                             "popular genres today. Comedies entertain us by making us laugh, but dramas entertain "
@@ -353,7 +346,10 @@ def main():
 
 
             if st.checkbox("How many movies were released over the years?"):
-                st.image("resources/nummovies_released.png")
+                fig, ax = plt.subplots(1, 1, figsize=(12, 6))
+                release_year_counts().set_index('year')['count'].plot(
+                    ax=ax, title='Movies released by year', xlabel='Year', ylabel='Number of movies')
+                st.pyplot(fig)
                 st.markdown("Technological changes mean that movies are easier and cheaper to make and distribute."
                             "  In addition, shifts in the industry mean that films spend far less long in cinemas "
                             "before moving on to other platforms, such as DVD and Video On Demand. "
@@ -642,6 +638,9 @@ def main():
         st.markdown("### Herpelot: Data Engineering and Analysis")
         st.image("resources/Pontso.png")
 
+    if page_selection == "Diagnostics":
+        show_diagnostics()
+
 
 
     # You may want to add more sections here for aspects such as an EDA,
@@ -0,0 +1,209 @@
+"""
+
+    Multi-core alternating least squares (ALS) matrix factorisation.
+
+    Description: A drop-in replacement for the single-threaded surprise
+    SGD fit in `resources/models/train_colbased.py`. It learns the same
+    model, r_ui = mu + b_u + b_i + p_u . q_i, from the same `ratings.csv`
+    and hyperparameters, but alternates between solving every user's
+    [p_u, b_u] with the items fixed and every item's [q_i, b_i] with the
+    users fixed. Each half-epoch is a set of independent least-squares
+    problems, which are split into blocks and solved by a pool of worker
+    processes.
+
+    The ratings and factors live in memory-mapped .npy files in a scratch
+    directory, so the workers share one physical copy of them and write
+    their solved rows in place.
+
+    SGD's learning rate (`lr_all`) has no ALS counterpart. `reg_all` is
+    applied per rating, as in surprise, which makes each row's penalty
+    `reg_all * n_ratings`.
+
+    Run `python -m recommenders.als` from the repository root. A
+    checkpoint is written after every epoch, and the final factors are
+    published as a new version of the factor store that
+    `collaborative_based.py` loads them from.
+
+"""
+# Script dependencies
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from .factors import FactorModel, factor_store_path, publish_factors
+from .fold_in import foldin_path, publish_fold_in
+from utils.ratings_store import RatingsStore
+
+checkpoint_path = "resources/models/als_checkpoint.npz"
+
+# Memory-mapped workspace of the current worker process
+_workspace = None
+
+
+def _open_workspace(workdir):
+    global _workspace
+    if _workspace is None or _workspace[0] != workdir:
+        arrays = {name: np.load(os.path.join(workdir, f"{name}.npy"), mmap_mode='r+')
+                  for name in ['pu', 'bu', 'qi', 'bi']}
+        _workspace = (workdir, RatingsStore.load(workdir), arrays)
+    return _workspace[1], _workspace[2]
+
+
+def _solve_block(workdir, side, start, stop, global_mean, reg):
+    """Solve rows [start, stop) of one side while the other side is fixed."""
+    store, arrays = _open_workspace(workdir)
+    if side == 'users':
+        indptr, columns, ratings = store.user_indptr, store.user_items, store.user_ratings
+        fixed_f, fixed_b, out_f, out_b = arrays['qi'], arrays['bi'], arrays['pu'], arrays['bu']
+    else:
+        indptr, columns, ratings = store.item_indptr, store.item_users, store.item_ratings
+        fixed_f, fixed_b, out_f, out_b = arrays['pu'], arrays['bu'], arrays['qi'], arrays['bi']
+
+    n_factors = fixed_f.shape[1]
+    grams = np.empty((stop - start, n_factors + 1, n_factors + 1))
+    rhs = np.empty((stop - start, n_factors + 1))
+    identity = np.eye(n_factors + 1)
+    for offset, row in enumerate(range(start, stop)):
+        cols = columns[indptr[row]:indptr[row + 1]]
+        design = np.empty((len(cols), n_factors + 1))
+        design[:, :-1] = fixed_f[cols]
+        design[:, -1] = 1.0
+        target = ratings[indptr[row]:indptr[row + 1]] - global_mean - fixed_b[cols]
+        grams[offset] = design.T @ design + reg * max(len(cols), 1) * identity
+        rhs[offset] = design.T @ target
+    solution = np.linalg.solve(grams, rhs[..., None])[..., 0]
+    out_f[start:stop] = solution[:, :-1]
+    out_b[start:stop] = solution[:, -1]
+
+
+def rmse(store, pu, bu, qi, bi, global_mean, chunk_size=65536):
+    """Root mean squared error of the factors on the stored ratings."""
+    user_rows = np.repeat(np.arange(store.n_users), np.diff(store.user_indptr))
+    squared = 0.0
+    for start in range(0, store.n_ratings, chunk_size):
+        users = user_rows[start:start + chunk_size]
+        items = store.user_items[start:start + chunk_size]
+        estimates = (global_mean + bu[users] + bi[items]
+                     + np.einsum('ij,ij->i', pu[users], qi[items]))
+        squared += np.sum((store.user_ratings[start:start + chunk_size] - estimates) ** 2)
+    return float(np.sqrt(squared / max(store.n_ratings, 1)))
+
+
+def train_als(ratings, n_factors=200, reg_all=0.02, n_epochs=40, init_std_dev=0.05,
+              n_jobs=None, block_size=128, checkpoint=checkpoint_path, resume=False,
+              random_state=0, verbose=True):
+    """Fit factors and biases to a ratings frame with parallel ALS.
+
+    Parameters
+    ----------
+    ratings : Pandas DataFrame
+        Ratings with userId, movieId and rating columns.
+    n_factors : int
+        Number of latent factors.
+    reg_all : float
+        Regularisation per rating of all factors and biases.
+    n_epochs : int
+        Number of user and item sweeps.
+    init_std_dev : float
+        Standard deviation of the initial factors.
+    n_jobs : int, optional
+        Worker processes. All cores are used by default.
+    block_size : int
+        Rows solved per task.
+    checkpoint : str, optional
+        File the factors are saved to after every epoch.
+    resume : bool
+        Continue from `checkpoint` instead of starting afresh.
+    random_state : int
+        Seed of the initial factors.
+    verbose : bool
+        Print the RMSE and wall time of every epoch.
+
+    Returns
+    -------
+    tuple (FactorModel, list (dict))
+        The trained factors and the RMSE and duration of every epoch.
+
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    store = RatingsStore.from_frame(ratings)
+    global_mean = float(np.mean(store.user_ratings))
+    rating_scale = (float(ratings['rating'].min()), float(ratings['rating'].max()))
+
+    rng = np.random.default_rng(random_state)
+    pu = rng.normal(0, init_std_dev, (store.n_users, n_factors))
+    qi = rng.normal(0, init_std_dev, (store.n_items, n_factors))
+    bu, bi = np.zeros(store.n_users), np.zeros(store.n_items)
+    first_epoch = 0
+    if resume and checkpoint and os.path.exists(checkpoint):
+        with np.load(checkpoint) as saved:
+            pu, bu, qi, bi = saved['pu'], saved['bu'], saved['qi'], saved['bi']
+            first_epoch = int(saved['epoch'])
+
+    history = []
+    with tempfile.TemporaryDirectory(prefix='als-') as workdir:
+        store.save(workdir)
+        for name, initial in [('pu', pu), ('bu', bu), ('qi', qi), ('bi', bi)]:
+            np.save(os.path.join(workdir, f"{name}.npy"), initial)
+        store, arrays = RatingsStore.load(workdir), {
+            name: np.load(os.path.join(workdir, f"{name}.npy"), mmap_mode='r+')
+            for name in ['pu', 'bu', 'qi', 'bi']}
+
+        pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+        try:
+            for epoch in range(first_epoch, n_epochs):
+                start = time.perf_counter()
+                for side, n_rows in [('users', store.n_users), ('items', store.n_items)]:
+                    tasks = [(workdir, side, block, min(block + block_size, n_rows),
+                              global_mean, reg_all)
+                             for block in range(0, n_rows, block_size)]
+                    if pool is None:
+                        for task in tasks:
+                            _solve_block(*task)
+                    else:
+                        # Raise any worker error before moving on
+                        list(pool.map(_solve_block, *zip(*tasks)))
+                elapsed = time.perf_counter() - start
+                error = rmse(store, arrays['pu'], arrays['bu'], arrays['qi'], arrays['bi'],
+                             global_mean)
+                history.append({'epoch': epoch + 1, 'rmse': error, 'seconds': elapsed})
+                if checkpoint:
+                    np.savez(checkpoint, epoch=epoch + 1,
+                             **{name: np.asarray(array) for name, array in arrays.items()})
+                if verbose:
+                    print(f"Epoch {epoch + 1}/{n_epochs}: train RMSE {error:.4f} in {elapsed:.2f}s")
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        model = FactorModel(np.array(arrays['pu']), np.array(arrays['qi']),
+                            np.array(arrays['bu']), np.array(arrays['bi']), global_mean,
+                            store.user_ids, store.item_ids, rating_scale)
+        del arrays, store
+    return model, history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the collaborative model with parallel ALS.")
+    parser.add_argument('--ratings', default='resources/data/ratings.csv')
+    parser.add_argument('--factors', type=int, default=200)
+    parser.add_argument('--reg', type=float, default=0.02)
+    parser.add_argument('--epochs', type=int, default=40)
+    parser.add_argument('--init-std-dev', type=float, default=0.05)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--store', default=factor_store_path)
+    args = parser.parse_args()
+
+    ratings = pd.read_csv(args.ratings, usecols=['userId', 'movieId', 'rating'])
+    model, _ = train_als(ratings, args.factors, args.reg, args.epochs, args.init_std_dev,
+                         n_jobs=args.jobs, resume=args.resume)
+    version = publish_factors(model, args.store, source='als')
+    print(f"Training completed. Published factors as version {version} of: {args.store}")
+    if os.path.exists(foldin_path):
+        # Ratings folded in since the last training are not in ratings.csv
+        _, version = publish_fold_in(root=args.store)
+        print(f"Folded the earlier fold-ins into version {version}.")
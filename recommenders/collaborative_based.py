@@ -28,67 +28,131 @@
 """
 
 # Script dependencies
-import pandas as pd
+import os
+import threading
 import numpy as np
-import pickle
-import copy
-from surprise import Reader, Dataset
-from surprise import SVD, NormalPredictor, BaselineOnly, KNNBasic, NMF
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import CountVectorizer
-import random
-
-# Importing data
-movies = pd.read_csv('resources/data/movies.csv')
-ratings = pd.read_csv('resources/data/ratings.csv')
-train = ratings.copy()
-
-# Data Preprocessing
-mt = pd.merge(train,movies, on= 'movieId', how = 'left')
-mt = mt.drop(['genres','rating','userId','timestamp'], axis = 1)
-mt = mt.drop_duplicates()
-mt = mt.dropna()
-movietitle = mt.copy()
-
-
-# We make use of a tuned SVD model trained on a subset of the MovieLens 10k dataset.
+from utils.catalog import load_catalog
+from utils.ratings_store import load_ratings_store
+from .factors import current_version, load_factors, load_trained_factors
+from .similarity import normalise_rows, top_k_similar
+from .item_neighbours import ItemNeighbours, neighbours_path
+from .result_cache import cached_recommendations
+from .jobs import stage
+from utils.data_loader import data_path, file_fingerprint
+from utils.tracing import span
+
+
+# We make use of a tuned SVD model trained on a subset of the MovieLens 10k dataset,
+# unless factors have been trained with `recommenders/als.py`.
+# It is exported once to `resources/models/factors` and memory mapped from there.
 model_load_path = "resources/models/tunedSVD_model.pkl"
-with open(model_load_path,'rb') as file:
-    model_tuned = pickle.load(file)
+# The factors are pulled out once so that scoring is a single product
+# Ratings folded in since training are published to the store too, see `recommenders/fold_in.py`
+svd_factors = load_trained_factors(model_load_path)
+_svd_factors_lock = threading.Lock()
 
+# Item-item neighbour tables are built offline by `recommenders/item_neighbours.py`.
+# They are only used while they match the current ratings.
+_item_neighbours = None
+_item_neighbours_lock = threading.Lock()
 
-def prediction_item(item_id):
+
+def load_svd_factors():
+    """Return the live factors, switching to a newly published version.
+
+    Returns
+    -------
+    recommenders.factors.FactorModel
+        Factors of the version the factor store currently names live.
+
+    """
+    global svd_factors
+    version = current_version()
+    with _svd_factors_lock:
+        if version is not None and version != svd_factors.version:
+            svd_factors = load_factors()
+        return svd_factors
+
+
+def _item_neighbours_key(path):
+    """What the neighbour table loaded from `path` depends on, or None without one."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+            file_fingerprint(data_path('ratings.csv'), data_path('movies.csv')))
+
+
+def load_item_neighbours(path=neighbours_path):
+    """Return the precomputed neighbour table, or None if it is unusable.
+
+    The table is read again whenever its file or the ratings change, so
+    a table built while the app is running is picked up.
+
+    Parameters
+    ----------
+    path : str
+        File in which the neighbour table is stored.
+
+    Returns
+    -------
+    tuple (ItemNeighbours, numpy.ndarray) or None
+        The table and a mask of its rows which have a title, or None when
+        no table has been built for the current ratings.
+
+    """
+    global _item_neighbours
+    key = _item_neighbours_key(path)
+    if key is None:
+        return None
+    with _item_neighbours_lock:
+        if _item_neighbours is None or _item_neighbours[0] != key:
+            table = ItemNeighbours.load(path)
+            usable = None
+            if table.source == file_fingerprint(data_path('ratings.csv')):
+                catalog = load_catalog(data_path('movies.csv'))
+                usable = (table, np.isin(table.item_ids, catalog.movie_ids))
+            _item_neighbours = (key, usable)
+        return _item_neighbours[1]
+
+
+def prediction_item(item_id, top_n=10):
     """Map a given favourite movie to users within the
        MovieLens dataset with the same preference.
 
+    Only used by `benchmarks/run.py`; `collab_model_batch` scores every
+    favourite in one product instead.
+
     Parameters
     ----------
     item_id : int
         A MovieLens Movie ID.
+    top_n : int
+        Number of users to return.
 
     Returns
     -------
     list
-        User IDs of users with similar high ratings for the given movie.
+        User IDs of users with similar high ratings for the given movie,
+        highest predicted rating first.
 
     """
-    # Data preprosessing
-    reader = Reader(rating_scale=(0, 5))
-    load_df = Dataset.load_from_df(train[['userId', 'movieId', 'rating']], reader)
-    a_train = load_df.build_full_trainset()
-
-    predictions = []
-    for ui in a_train.all_users():
-        predictions.append(model_tuned.predict(iid=item_id, uid=ui, verbose=False))
-    return predictions
+    # Predicting the rating of every user at once
+    factors = load_svd_factors()
+    with span('svd predictions', items=len(factors.user_ids)):
+        return factors.top_users(item_id, top_n).tolist()
 
 def pred_movies(movie_list):
     """Maps the given favourite movies selected within the app to corresponding
     users within the MovieLens dataset.
 
+    Kept as the per-movie baseline for `benchmarks/run.py`, the app no
+    longer calls it.
+
     Parameters
     ----------
-    movie_list : list
+    movie_list : list (str)
         Three favourite movies selected by the app user.
 
     Returns
@@ -97,22 +161,118 @@ def pred_movies(movie_list):
         User-ID's of users with similar high ratings for each movie.
 
     """
+    catalog = load_catalog(data_path('movies.csv'))
     # Store the id of users
     id_store = []
     # For each movie selected by a user of the app,
     # predict a corresponding user within the dataset with the highest rating
     for i in movie_list:
-        # movie_id = movietitle[movietitle['title'] == i]['movieId'].values[0]
-        predictions = prediction_item(item_id=i)
-        predictions.sort(key=lambda x: x.est, reverse=True)
+        movie_id = catalog.id_of_title(i)
         # Take the top 10 user id's from each movie with highest rankings
-        for pred in predictions[:10]:
-            id_store.append(pred.uid)
+        id_store.extend(prediction_item(item_id=movie_id, top_n=10))
     # Return a list of user id's
     return id_store
 
+def _neighbourhood_recommend(catalog, store, user_ids, movie_ids, top_n):
+    """Rank the movies rated by a neighbourhood of users by similarity to the favourites.
+
+    Returns None when none of the favourites has been rated.
+
+    """
+    # Rows of the neighbourhood, without repeats
+    user_rows = [store.user_row(i) for i in dict.fromkeys(user_ids)]
+    user_rows = [i for i in user_rows if i is not None]
+
+    # Getting the item-user matrix of the neighbourhood, keeping the movies
+    # they rated which have a title, plus the chosen movies themselves
+    users_matrix = store.user_submatrix(user_rows)
+    favourite_rows = [store.item_row(i) for i in movie_ids]
+    favourite_rows = [i for i in favourite_rows if i is not None]
+    item_rows = np.union1d(np.unique(users_matrix.indices), favourite_rows).astype(np.int64)
+    item_rows = item_rows[np.isin(store.item_ids[item_rows], catalog.movie_ids)]
+    items_matrix = users_matrix[:, item_rows].T.tocsr()
+    indices = catalog.subset(store.item_ids[item_rows])
+    favourite_indices = np.flatnonzero(np.isin(item_rows, favourite_rows))
+    if not len(favourite_indices):
+        return None
+
+    # Summing the cosine similarities to the chosen movies and keeping the
+    # best matches, excluding the chosen movies themselves
+    top_indx, _ = top_k_similar(normalise_rows(items_matrix), favourite_indices, k=top_n)
+    return [indices.titles[j] for j in top_indx]
+
+def collab_model_batch(movie_lists, top_n=10):
+    """Collaborative filtering for many lists of favourite movies at once.
+
+    Favourites found in the neighbour table are answered from it. For the
+    others, the predicted ratings of every user for all of their
+    favourites are computed in a single matrix product before each
+    neighbourhood is ranked.
+
+    Parameters
+    ----------
+    movie_lists : list (list (str))
+        Favourite movies of each user.
+    top_n : int
+        Number of top recommendations to return to each user.
+
+    Returns
+    -------
+    list (list (str))
+        Titles of the top-n movie recommendations for each user, in the
+        order of `movie_lists`. None for users none of whose favourites
+        are known movies.
+
+    """
+    stage('resolving titles')
+    catalog = load_catalog(data_path('movies.csv'))
+    # Ids of the favourites which are in the catalogue
+    favourite_ids = [[movie_id for movie_id in map(catalog.id_of_title, movie_list)
+                      if movie_id is not None] for movie_list in movie_lists]
+    recommendations = [None] * len(movie_lists)
+    # Merging the precomputed neighbours of the chosen movies when available
+    neighbour_table = load_item_neighbours()
+    if neighbour_table is not None:
+        table, has_title = neighbour_table
+        stage('scoring')
+        with span('neighbour table', items=len(movie_lists)):
+            for n, movie_ids in enumerate(favourite_ids):
+                favourite_rows = [table.item_row(i) for i in movie_ids]
+                favourite_rows = [i for i in favourite_rows if i is not None]
+                if favourite_rows:
+                    top_indx = table.recommend(favourite_rows, top_n, allowed=has_title)
+                    recommendations[n] = [catalog.title_of_id(int(table.item_ids[j]))
+                                          for j in top_indx]
+
+    remaining = [n for n, result in enumerate(recommendations)
+                 if result is None and favourite_ids[n]]
+    if remaining:
+        stage('scoring')
+        # The top 10 users of every favourite movie, from one product
+        movie_ids = list(dict.fromkeys(i for n in remaining for i in favourite_ids[n]))
+        factors = load_svd_factors()
+        with span('svd predictions', items=len(movie_ids) * len(factors.user_ids)):
+            top_users = dict(zip(movie_ids, factors.top_users_batch(movie_ids, 10)))
+        store = load_ratings_store()
+        with span('neighbourhood', items=len(remaining)):
+            for n in remaining:
+                user_ids = [user_id for i in favourite_ids[n]
+                            for user_id in top_users[i].tolist()]
+                recommendations[n] = _neighbourhood_recommend(catalog, store, user_ids,
+                                                              favourite_ids[n], top_n)
+    stage('ranking')
+    return recommendations
+
+def _model_version():
+    """Version of the results `collab_model` returns, for the result cache."""
+    # The neighbour table answers instead of the factors whenever it is usable
+    return (load_svd_factors().version, _item_neighbours_key(neighbours_path),
+            file_fingerprint(data_path('ratings.csv'), data_path('movies.csv')))
+
 # !! DO NOT CHANGE THIS FUNCTION SIGNATURE !!
 # You are, however, encouraged to change its content.  
+# Repeated favourite sets are answered from `recommenders/result_cache.py`.
+@cached_recommendations('collab', _model_version)
 def collab_model(movie_list,top_n=10):
     """Performs Collaborative filtering based upon a list of movies supplied
        by the app user.
@@ -131,48 +291,7 @@ def collab_model(movie_list,top_n=10):
 
     """
 
-    movie_ids = pred_movies(movie_list)
-    df_init_users = train[train['userId'] == movie_ids[0]]
-    for i in movie_ids[1:]:
-        df_init_users = df_init_users.append(train[train['userId'] == i])
-
-    # Getting the user-item matrix
-    df_init_users = pd.merge(df_init_users, movietitle, on='movieId', how='left')
-    df_init_users = df_init_users.dropna()
-    users_matrix = df_init_users.groupby(['title', 'userId'])['rating'].max().unstack()
-    for i in movie_list:
-        if i not in users_matrix.index.values.tolist():
-            df_nan = pd.DataFrame([[(np.NaN)] * len(users_matrix.columns)], index=[i], columns=users_matrix.columns)
-            users_matrix = users_matrix.append(df_nan)
-
-    # Getting the cosine similarity matrix
-    cosine_sim = cosine_similarity(users_matrix.fillna(0))
-    indices = pd.Series(users_matrix.index)
-    idx_1 = indices[indices == movie_list[0]].index[0]
-    idx_2 = indices[indices == movie_list[1]].index[0]
-    idx_3 = indices[indices == movie_list[2]].index[0]
-
-    # Creating a Series with the similarity scores in descending order
-    rank_1 = cosine_sim[idx_1]
-    rank_2 = cosine_sim[idx_2]
-    rank_3 = cosine_sim[idx_3]
-
-    # Calculating the scores
-    score_series_1 = pd.Series(rank_1).sort_values(ascending=False)
-    score_series_2 = pd.Series(rank_2).sort_values(ascending=False)
-    score_series_3 = pd.Series(rank_3).sort_values(ascending=False)
-
-    # Appending the names of movies
-    listings = score_series_1.append(score_series_2).append(score_series_3).sort_values(ascending=False)
-    recommended_movies = []
-
-    # Choose top 50
-    top_50_indx = list(listings.iloc[1:50].index)
-
-    # Removing chosen movies
-    top_indx = np.setdiff1d(top_50_indx, [idx_1, idx_2, idx_3])
-    random.shuffle(top_indx)
-    for j in top_indx[:top_n]:
-        recommended_movies.append(indices[j])
-
+    recommended_movies = collab_model_batch([movie_list], top_n)[0]
+    if recommended_movies is None:
+        raise ValueError("None of the chosen movies have been rated.")
     return recommended_movies
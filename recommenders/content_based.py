@@ -29,25 +29,70 @@
 
 # Script dependencies
 import os
-import pandas as pd
+import json
+import threading
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+from .similarity import normalise_rows, batch_top_k_similar
+from .ann import LSHIndex
+from .result_cache import cached_recommendations
+from .jobs import stage
+from utils.catalog import load_catalog
+from utils.data_loader import cached_frame, data_path, load_imdb, load_movies
+from utils.tracing import span, traced
 from sklearn.feature_extraction.text import CountVectorizer
 
-# Importing data
-ratings = pd.read_csv('resources/data/ratings.csv')
-movies = pd.read_csv('resources/data/movies.csv')
-df_imdb = pd.read_csv('resources/data/imdb_data.csv')
+# The fitted content index is persisted here and loaded on first use.
+content_index_path = "resources/models/content_index"
+_content_index = None
+_content_index_lock = threading.Lock()
 
-#movies.dropna(inplace=True)
+# Approximate nearest-neighbour search is opt-in, for catalogs large enough
+# that exact top-k becomes too slow. See `recommenders/ann.py` for the knobs.
+use_ann = False
+ann_index_path = "resources/models/content_index/ann.npz"
+_ann_index = None
 
-def data_preprocessing(subset_size):
+def _build_content_features():
+    """Combine the cast, director, keywords and genres of every movie."""
+    imdb = load_imdb()[['movieId', 'title_cast', 'director', 'plot_keywords']]
+    titles = load_movies()
+    # Inner join the imdb dataframe with the movies dataframe
+    merge = imdb.merge(titles[['movieId', 'genres', 'title']], on='movieId', how='inner')
+
+    # Convert data types to string in order to do string manipulation
+    for column in ['title_cast', 'plot_keywords', 'genres', 'director']:
+        merge[column] = merge[column].astype(str)
+
+    # clean directors and title_cast column
+    # lower case, remove spaces within names and separate names by spaces
+    merge['director'] = merge['director'].str.lower().str.replace(r'\s+', '', regex=True)
+    merge['title_cast'] = (merge['title_cast'].str.lower()
+                           .str.replace(r'\s+', '', regex=True)
+                           .str.replace(r'[|,]', ' ', regex=True))
+
+    # clean plot keywords column
+    # separate keywords by spaces instead of "|"
+    merge['plot_keywords'] = merge['plot_keywords'].str.replace('|', ' ', regex=False)
+
+    # clean plot genres column
+    # lower case and separate genres by spaces instead of "|"
+    merge['genres'] = merge['genres'].str.lower().str.replace('|', ' ', regex=False)
+
+    # we combine the features columns into  single string
+    merge['combined_features'] = merge['title_cast'].str.cat(
+        merge[['director', 'plot_keywords', 'genres']], sep=' ')
+    return merge
+
+@traced('data_preprocessing')
+def data_preprocessing(subset_size=None):
     """Prepare data for use within Content filtering algorithm.
 
     Parameters
     ----------
-    subset_size : int
-        Number of movies to use within the algorithm.
+    subset_size : int, optional
+        Number of movies to use within the algorithm. The whole catalog is
+        used when omitted.
 
     Returns
     -------
@@ -55,47 +100,273 @@ def data_preprocessing(subset_size):
         Subset of movies selected for content-based filtering.
 
     """
-    # Inner join the imdb dataframe with the movies dataframe
-    imdb = df_imdb[['movieId', 'title_cast', 'director', 'plot_keywords']]
-    merge = imdb.merge(movies[['movieId', 'genres', 'title']], on='movieId', how='inner')
+    merge = cached_frame('content_features',
+                         [data_path('imdb_data.csv'), data_path('movies.csv')],
+                         _build_content_features)
+    merge_subset = merge[:subset_size]
 
-    # Convert data types to string in order to do string manipulation
-    merge['title_cast'] = merge.title_cast.astype(str)
-    merge['plot_keywords'] = merge.plot_keywords.astype(str)
-    merge['genres'] = merge.genres.astype(str)
-    merge['director'] = merge.director.astype(str)
+    return merge_subset
 
-    # clean directors and title_cast column
-    # remove spaces and "|"
-    merge['director'] = merge['director'].apply(lambda x: "".join(x.lower() for x in x.split()))
-    merge['title_cast'] = merge['title_cast'].apply(lambda x: "".join(x.lower() for x in x.split()))
-    merge['title_cast'] = merge['title_cast'].map(lambda x: x.split('|'))
-    # convert title cast back to string and remove commas
-    merge['title_cast'] = merge['title_cast'].apply(lambda x: ','.join(map(str, x)))
-    merge['title_cast'] = merge['title_cast'].replace(',', ' ', regex=True)
+class ContentIndex:
+    """Fitted content features for every movie used by `content_model`.
 
-    # clean plot keywords column
-    # remove spaces and "|"
-    merge['plot_keywords'] = merge['plot_keywords'].map(lambda x: x.split('|'))
-    merge['plot_keywords'] = merge['plot_keywords'].apply(lambda x: " ".join(x))
+    Attributes
+    ----------
+    vocabulary : list (str)
+        Tokens of the fitted vectorizer, ordered by feature column.
+    features : scipy.sparse.csr_matrix
+        Token counts with one row per indexed movie.
+    normalised : scipy.sparse.csr_matrix
+        `features` with L2-normalised rows, used for cosine scoring.
+    movie_ids : numpy.ndarray
+        MovieLens Movie ID of each row in `features`.
+    catalog : utils.catalog.Catalog
+        Title and movie ID lookups for the rows of `features`.
+    version : int
+        Incremented every time movies are added to the index.
 
-    # clean plot genres column
-    # remove spaces and "|"
-    merge['genres'] = merge['genres'].map(lambda x: x.lower().split('|'))
-    merge['genres'] = merge['genres'].apply(lambda x: " ".join(x))
+    """
 
-    # subset table to only return required columns
-    df_features = merge[['title_cast', 'director', 'plot_keywords', 'genres']]
+    def __init__(self, vocabulary, features, movie_ids, version=0):
+        self.vocabulary = vocabulary
+        self.features = sparse.csr_matrix(features)
+        self.normalised = normalise_rows(self.features)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.catalog = load_catalog(data_path('movies.csv')).subset(self.movie_ids)
+        self.version = version
 
-    # we combine the features columns into  single string
-    merge['combined_features'] = df_features['title_cast'] + ' ' + df_features['director'] + ' ' + df_features[
-        'plot_keywords'] + ' ' + df_features['genres']
-    merge_subset = merge[:subset_size]
+    def extend(self, movie_ids, documents):
+        """Index additional movies without refitting the existing rows.
 
-    return merge_subset
+        Documents are tokenised exactly like `CountVectorizer` does when
+        the index is built. Tokens which have not been seen before are
+        appended to the vocabulary as new feature columns.
+
+        Parameters
+        ----------
+        movie_ids : array-like (int)
+            MovieLens Movie IDs of the new movies.
+        documents : list (str)
+            Combined features of the new movies, see `data_preprocessing`.
+
+        Returns
+        -------
+        ContentIndex
+            A new index holding the existing rows followed by the new ones.
+
+        """
+        analyse = CountVectorizer().build_analyzer()
+        vocabulary = list(self.vocabulary)
+        columns = {token: column for column, token in enumerate(vocabulary)}
+        indptr, indices = [0], []
+        for document in documents:
+            for token in analyse(document):
+                column = columns.get(token)
+                if column is None:
+                    column = columns[token] = len(vocabulary)
+                    vocabulary.append(token)
+                indices.append(column)
+            indptr.append(len(indices))
+        new_rows = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=self.features.dtype), indices, indptr),
+            shape=(len(indptr) - 1, len(vocabulary)))
+        new_rows.sum_duplicates()
+        old_rows = self.features.copy()
+        old_rows.resize((old_rows.shape[0], len(vocabulary)))
+        return ContentIndex(vocabulary, sparse.vstack([old_rows, new_rows], format='csr'),
+                            np.concatenate([self.movie_ids, np.asarray(movie_ids, dtype=np.int64)]),
+                            self.version + 1)
+
+    def save(self, path):
+        """Write the index to the directory `path`."""
+        os.makedirs(path, exist_ok=True)
+        sparse.save_npz(os.path.join(path, 'features.npz'), self.features, compressed=False)
+        np.save(os.path.join(path, 'movie_ids.npy'), self.movie_ids)
+        with open(os.path.join(path, 'vocabulary.json'), 'w') as file:
+            json.dump(self.vocabulary, file)
+        with open(os.path.join(path, 'manifest.json'), 'w') as file:
+            json.dump({'version': self.version, 'n_movies': len(self.movie_ids)}, file)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index previously written with `save`."""
+        features = sparse.load_npz(os.path.join(path, 'features.npz'))
+        movie_ids = np.load(os.path.join(path, 'movie_ids.npy'))
+        with open(os.path.join(path, 'vocabulary.json')) as file:
+            vocabulary = json.load(file)
+        version = 0
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            with open(os.path.join(path, 'manifest.json')) as file:
+                version = json.load(file)['version']
+        return cls(vocabulary, features, movie_ids, version)
+
+
+def build_content_index(save_path=content_index_path):
+    """Fit the content features once and persist them to disk.
+
+    Parameters
+    ----------
+    save_path : str
+        Directory in which the index is stored.
+
+    Returns
+    -------
+    ContentIndex
+        The freshly fitted index.
+
+    """
+    processed_df = data_preprocessing()
+    cv = CountVectorizer()
+    with span('vectorise', items=len(processed_df)):
+        features = cv.fit_transform(processed_df['combined_features'])
+    index = ContentIndex(cv.get_feature_names_out().tolist(), features,
+                         processed_df['movieId'].to_numpy())
+    index.save(save_path)
+    return index
+
+
+def load_content_index(path=content_index_path):
+    """Return the process-wide content index, building it if it is missing.
+
+    Parameters
+    ----------
+    path : str
+        Directory in which the index is stored.
+
+    Returns
+    -------
+    ContentIndex
+        Index shared by all calls to `content_model`.
+
+    """
+    global _content_index
+    with _content_index_lock:
+        if _content_index is None:
+            if os.path.exists(os.path.join(path, 'features.npz')):
+                _content_index = ContentIndex.load(path)
+            else:
+                _content_index = build_content_index(path)
+    return _content_index
+
+def update_content_index(path=content_index_path):
+    """Add movies which are missing from the saved content index.
+
+    New titles in `movies.csv` and `imdb_data.csv` are appended to the
+    index, extending its vocabulary, instead of refitting every movie.
+    Rows of movies which are already indexed are left unchanged; rebuild
+    the index with `build_content_index` to pick up edits to them.
+
+    Parameters
+    ----------
+    path : str
+        Directory in which the index is stored.
+
+    Returns
+    -------
+    ContentIndex
+        The updated index, which is also used by later calls to
+        `content_model`.
+
+    """
+    global _content_index, _ann_index
+    index = load_content_index(path)
+    processed_df = data_preprocessing()
+    new_movies = processed_df[~processed_df['movieId'].isin(index.movie_ids)]
+    if new_movies.empty:
+        return index
+
+    updated = index.extend(new_movies['movieId'].to_numpy(),
+                           new_movies['combined_features'].tolist())
+    updated.save(path)
+    with _content_index_lock:
+        _content_index = updated
+        if _ann_index is None and os.path.exists(ann_index_path):
+            _ann_index = LSHIndex.load(ann_index_path)
+        if _ann_index is not None and _ann_fits(_ann_index, index):
+            _ann_index = _ann_index.extend(updated.normalised[index.features.shape[0]:])
+            _ann_index.save(ann_index_path)
+    return updated
+
+def _ann_fits(ann_index, index):
+    """Whether an LSH index was fitted on the movies and vocabulary of a content index."""
+    # The hyperplanes have one row per feature column
+    return (ann_index.n_items == index.features.shape[0]
+            and ann_index.planes.shape[0] == index.features.shape[1])
+
+def load_ann_index(path=ann_index_path):
+    """Return the LSH index over the content index, building it if needed.
+
+    Parameters
+    ----------
+    path : str
+        File in which the LSH index is stored.
+
+    Returns
+    -------
+    recommenders.ann.LSHIndex
+        Index over the rows of the current content index.
+
+    """
+    global _ann_index
+    index = load_content_index()
+    with _content_index_lock:
+        if _ann_index is None and os.path.exists(path):
+            _ann_index = LSHIndex.load(path)
+        # An index fitted on another version of the catalog is rebuilt
+        if _ann_index is None or not _ann_fits(_ann_index, index):
+            _ann_index = LSHIndex().fit(index.normalised)
+            _ann_index.save(path)
+    return _ann_index
+
+def content_model_batch(movie_lists, top_n=10):
+    """Content filtering for many lists of favourite movies at once.
+
+    Parameters
+    ----------
+    movie_lists : list (list (str))
+        Favourite movies of each user.
+    top_n : int
+        Number of top recommendations to return to each user.
+
+    Returns
+    -------
+    list (list (str))
+        Titles of the top-n movie recommendations for each user, in the
+        order of `movie_lists`. None for users whose favourites are all
+        missing from the content index.
+
+    """
+    stage('resolving titles')
+    index = load_content_index()
+    with span('resolve titles', items=len(movie_lists)):
+        # Getting the rows of the movies that match the titles
+        query_sets = [index.catalog.rows_of_titles(movie_list) for movie_list in movie_lists]
+        known = [i for i, rows in enumerate(query_sets) if rows]
+
+    stage('scoring')
+    with span('similarity', items=len(known)):
+        if use_ann:
+            ann_index = load_ann_index()
+            results = [ann_index.top_k_similar(index.normalised, query_sets[i], k=top_n)
+                       for i in known]
+        else:
+            results = batch_top_k_similar(index.normalised, [query_sets[i] for i in known],
+                                          k=top_n)
+
+    stage('ranking')
+    recommendations = [None] * len(movie_lists)
+    for i, (top_indexes, _) in zip(known, results):
+        recommendations[i] = index.catalog.titles[top_indexes].tolist()
+    return recommendations
+
+def _index_version():
+    """Version of the results `content_model` returns, for the result cache."""
+    return load_content_index().version, use_ann
 
 # !! DO NOT CHANGE THIS FUNCTION SIGNATURE !!
 # You are, however, encouraged to change its content.  
+# Repeated favourite sets are answered from `recommenders/result_cache.py`.
+@cached_recommendations('content', _index_version)
 def content_model(movie_list,top_n=10):
     """Performs Content filtering based upon a list of movies supplied
        by the app user.
@@ -113,34 +384,11 @@ def content_model(movie_list,top_n=10):
         Titles of the top-n movie recommendations to the user.
 
     """
-    # Initializing the empty list of recommended movies
-    processed_df = data_preprocessing(12000)
-    # Instantiating and generating the count matrix
-    cv = CountVectorizer()
-    cv_model = cv.fit_transform(processed_df['combined_features'])
-    indices = pd.DataFrame(processed_df.index)
-    cosine_sim = cosine_similarity(cv_model, cv_model)
-    # Getting the index of the movie that matches the title
-    idx_1 = indices[indices == movie_list[0]].index[0]
-    idx_2 = indices[indices == movie_list[1]].index[0]
-    idx_3 = indices[indices == movie_list[2]].index[0]
-    # Creating a Series with the similarity scores in descending order
-    rank_1 = cosine_sim[idx_1]
-    rank_2 = cosine_sim[idx_2]
-    rank_3 = cosine_sim[idx_3]
-    # Calculating the scores
-    score_series_1 = pd.Series(rank_1).sort_values(ascending=False)
-    score_series_2 = pd.Series(rank_2).sort_values(ascending=False)
-    score_series_3 = pd.Series(rank_3).sort_values(ascending=False)
-    # Getting the indexes of the 10 most similar movies
-    listings = score_series_1.append(score_series_1).append(score_series_3).sort_values(ascending=False)
-
-    # Store movie names
-    recommended_movies = []
-    # Appending the names of movies
-    top_50_indexes = list(listings.iloc[1:50].index)
-    # Removing chosen movies
-    top_indexes = np.setdiff1d(top_50_indexes, [idx_1, idx_2, idx_3])
-    for i in top_indexes[:top_n]:
-        recommended_movies.append(list(movies['title'])[i])
+    recommended_movies = content_model_batch([movie_list], top_n)[0]
+    if recommended_movies is None:
+        raise ValueError("None of the chosen movies are in the content index.")
     return recommended_movies
+
+if __name__ == '__main__':
+    index = update_content_index()
+    print(f"Content index version {index.version} holds {len(index.catalog)} movies.")
@@ -0,0 +1,412 @@
+"""
+
+    Vectorised scoring with the latent factors of a trained SVD model.
+
+    Description: surprise's `SVD.predict` scores a single (user, item) pair
+    at a time through Python-level id lookups. The factors and biases it
+    uses are plain arrays, so the predicted ratings of every user for an
+    item reduce to one matrix-vector product:
+
+        r_ui = mu + b_u + b_i + p_u . q_i
+
+    `FactorModel` holds those arrays together with the raw MovieLens ids
+    of their rows.
+
+    Serving loads them from a factor store rather than the pickled model:
+    a directory of versions, each holding the arrays as .npy files next to
+    a small JSON manifest, with a `CURRENT` file naming the live version.
+    The arrays are memory mapped read-only, so start-up does not parse the
+    model and every server process shares the same pages of the OS page
+    cache. New versions are written beside the live one and switched to
+    atomically, so running processes keep a consistent view.
+
+    Ratings folded in since training, see `recommenders/fold_in.py`, are
+    published as versions of their own rather than applied when the
+    factors are loaded. Every version records the trained version it
+    derives from as its `base_version`.
+
+"""
+# Script dependencies
+import os
+import re
+import json
+import shutil
+import pickle
+import argparse
+import datetime
+import numpy as np
+
+from .similarity import top_k
+
+factor_store_path = "resources/models/factors"
+# Layout of a factor store version, bumped on incompatible changes
+STORE_FORMAT = 1
+_ARRAYS = ['pu', 'qi', 'bu', 'bi', 'user_ids', 'item_ids']
+
+
+class FactorModel:
+    """Latent factors, biases and id mappings of a factorisation model.
+
+    Parameters
+    ----------
+    pu : numpy.ndarray
+        User factors, one row per user.
+    qi : numpy.ndarray
+        Item factors, one row per item.
+    bu : numpy.ndarray
+        User biases.
+    bi : numpy.ndarray
+        Item biases.
+    global_mean : float
+        Mean rating of the training data.
+    user_ids : array-like (int)
+        MovieLens User ID of each row of `pu`.
+    item_ids : array-like (int)
+        MovieLens Movie ID of each row of `qi`.
+    rating_scale : tuple (float, float)
+        Predictions are clipped to this range, as surprise does.
+    version : int, optional
+        Factor store version the arrays were loaded from.
+    base_version : int, optional
+        Version of the trained factors these derive from, `version`
+        itself unless rows were folded in or the precision changed.
+
+    """
+
+    def __init__(self, pu, qi, bu, bi, global_mean, user_ids, item_ids, rating_scale=(0.5, 5.0),
+                 version=None, base_version=None):
+        self.pu = pu
+        self.qi = qi
+        self.bu = bu
+        self.bi = bi
+        self.global_mean = float(global_mean)
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        self.rating_scale = tuple(float(r) for r in rating_scale)
+        self.version = version
+        self.base_version = version if base_version is None else base_version
+        # Id lookups are only built once they are first needed
+        self._user_rows = None
+        self._item_rows = None
+
+    @classmethod
+    def from_surprise(cls, model):
+        """Extract the factors of a fitted `surprise.SVD` model.
+
+        Parameters
+        ----------
+        model : surprise.SVD
+            A fitted model, still holding its trainset.
+
+        Returns
+        -------
+        FactorModel
+            Arrays equivalent to the model's predictions.
+
+        """
+        trainset = model.trainset
+        user_ids = [trainset.to_raw_uid(inner) for inner in range(trainset.n_users)]
+        item_ids = [trainset.to_raw_iid(inner) for inner in range(trainset.n_items)]
+        if model.biased:
+            bu, bi, global_mean = model.bu, model.bi, trainset.global_mean
+        else:
+            bu, bi, global_mean = np.zeros(trainset.n_users), np.zeros(trainset.n_items), 0.0
+        return cls(model.pu, model.qi, bu, bi, global_mean, user_ids, item_ids,
+                   trainset.rating_scale)
+
+    def save(self, path, **manifest):
+        """Write the factors to the directory `path`.
+
+        Parameters
+        ----------
+        path : str
+            Directory to create. One .npy file is written per array.
+        manifest : dict
+            Extra entries for `manifest.json`.
+
+        """
+        os.makedirs(path)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        manifest = dict(manifest, format=STORE_FORMAT, global_mean=self.global_mean,
+                        rating_scale=list(self.rating_scale), n_users=len(self.user_ids),
+                        n_items=len(self.item_ids), n_factors=self.n_factors,
+                        dtype=str(self.pu.dtype))
+        with open(os.path.join(path, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Read factors written with `save`, memory mapping the arrays."""
+        manifest = _read_manifest(path)
+        if manifest.get('precision') and cls is FactorModel:
+            from .quantise import QuantisedFactorModel
+            return QuantisedFactorModel.load(path, mmap_mode)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in _ARRAYS}
+        return cls(arrays['pu'], arrays['qi'], arrays['bu'], arrays['bi'],
+                   manifest['global_mean'], arrays['user_ids'], arrays['item_ids'],
+                   manifest['rating_scale'], manifest.get('version'), manifest.get('base_version'))
+
+    @property
+    def n_factors(self):
+        return self.pu.shape[1]
+
+    def user_row(self, user_id):
+        """Row of `user_id`, or None for users unknown to the model."""
+        if self._user_rows is None:
+            self._user_rows = {user_id: row for row, user_id in enumerate(self.user_ids.tolist())}
+        return self._user_rows.get(user_id)
+
+    def item_row(self, item_id):
+        """Row of `item_id`, or None for items unknown to the model."""
+        if self._item_rows is None:
+            self._item_rows = {item_id: row for row, item_id in enumerate(self.item_ids.tolist())}
+        return self._item_rows.get(item_id)
+
+    def overlay(self, user_ids, pu, bu, item_ids, qi, bi):
+        """The model with some rows replaced or added.
+
+        Parameters
+        ----------
+        user_ids, pu, bu : numpy.ndarray
+            Users with their new factors and biases.
+        item_ids, qi, bi : numpy.ndarray
+            Items with their new factors and biases.
+
+        Returns
+        -------
+        FactorModel
+            A new model. Only the arrays which change are copied.
+
+        """
+        (pu, bu), user_ids = _overlay([self.pu, self.bu], self.user_ids, self.user_row,
+                                      [pu, bu], user_ids)
+        (qi, bi), item_ids = _overlay([self.qi, self.bi], self.item_ids, self.item_row,
+                                      [qi, bi], item_ids)
+        return FactorModel(pu, qi, bu, bi, self.global_mean, user_ids, item_ids,
+                           self.rating_scale, self.version, self.base_version)
+
+    def dequantised(self):
+        """The model with full precision factors, see `recommenders/quantise.py`."""
+        return self
+
+    def predict_rows(self, user_rows, item_rows):
+        """Clipped predictions for pairs of user and item rows."""
+        estimates = (self.global_mean + self.bu[user_rows] + self.bi[item_rows]
+                     + np.einsum('ij,ij->i', self.pu[user_rows], self.qi[item_rows]))
+        return np.clip(estimates, *self.rating_scale)
+
+    def predict_item(self, item_id):
+        """Predicted rating of every user for one item.
+
+        Parameters
+        ----------
+        item_id : int
+            A MovieLens Movie ID.
+
+        Returns
+        -------
+        numpy.ndarray
+            One clipped prediction per row of `user_ids`. Unknown items
+            are scored by the user biases alone, like `SVD.predict`.
+
+        """
+        estimates = self.global_mean + np.asarray(self.bu, dtype=np.float64)
+        row = self.item_row(item_id)
+        if row is not None:
+            estimates = estimates + self.bi[row] + self.pu @ self.qi[row]
+        return np.clip(estimates, *self.rating_scale)
+
+    def predict_items(self, item_ids):
+        """Predicted rating of every user for several items at once.
+
+        Parameters
+        ----------
+        item_ids : list (int)
+            MovieLens Movie IDs. Unknown items are scored by the user
+            biases alone.
+
+        Returns
+        -------
+        numpy.ndarray
+            Clipped predictions, one row per user and one column per item.
+
+        """
+        rows = [self.item_row(item_id) for item_id in item_ids]
+        known = [i for i, row in enumerate(rows) if row is not None]
+        estimates = np.repeat(self.global_mean + np.asarray(self.bu, dtype=np.float64)[:, None],
+                              len(rows), axis=1)
+        if known:
+            known_rows = [rows[i] for i in known]
+            estimates[:, known] += self.bi[known_rows] + self.pu @ self.qi[known_rows].T
+        return np.clip(estimates, *self.rating_scale)
+
+    def top_users_batch(self, item_ids, n=10):
+        """`top_users` of several items, scored in one matrix product."""
+        estimates = self.predict_items(item_ids)
+        return [self.user_ids[top_k(estimates[:, i], n)] for i in range(len(item_ids))]
+
+    def top_users(self, item_id, n=10):
+        """Users predicted to rate an item the highest.
+
+        Parameters
+        ----------
+        item_id : int
+            A MovieLens Movie ID.
+        n : int
+            Number of users to return.
+
+        Returns
+        -------
+        numpy.ndarray
+            MovieLens User IDs, highest predicted rating first.
+
+        """
+        return self.user_ids[top_k(self.predict_item(item_id), n)]
+
+
+def _overlay(arrays, ids, row_of, new_arrays, new_ids):
+    """Replace the rows of known ids in `arrays` and append the others."""
+    new_ids = np.asarray(new_ids, dtype=np.int64)
+    if not len(new_ids):
+        return arrays, ids
+    rows = np.array([row_of(i) if row_of(i) is not None else -1 for i in new_ids.tolist()],
+                    dtype=np.int64)
+    known = rows >= 0
+    merged = []
+    for array, new in zip(arrays, new_arrays):
+        array = np.concatenate([array, new[~known].astype(array.dtype)])
+        array[rows[known]] = new[known]
+        merged.append(array)
+    return merged, np.concatenate([ids, new_ids[~known]])
+
+
+def _read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as file:
+        manifest = json.load(file)
+    if manifest['format'] != STORE_FORMAT:
+        raise ValueError(f"Unsupported factor store format {manifest['format']} in {path}.")
+    return manifest
+
+
+def _store_versions(root):
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(match.group(1)) for match in
+                  (re.fullmatch(r'v(\d+)', name) for name in os.listdir(root)) if match)
+
+
+def current_version(root=factor_store_path):
+    """The live version of a factor store, or None if it is empty."""
+    try:
+        with open(os.path.join(root, 'CURRENT')) as file:
+            return int(file.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def publish_factors(model, root=factor_store_path, source=None, keep=3):
+    """Write a model as the new live version of a factor store.
+
+    Parameters
+    ----------
+    model : FactorModel
+        Factors to publish. Their `base_version` is kept, so that factors
+        derived from a loaded version do not count as a retrained model.
+    root : str
+        Directory of the factor store.
+    source : str, optional
+        Description of where the factors come from, for the manifest.
+    keep : int
+        Number of most recent versions kept on disk.
+
+    Returns
+    -------
+    int
+        The published version.
+
+    """
+    version = max(_store_versions(root), default=0) + 1
+    path = os.path.join(root, f"v{version:06d}")
+    staging = path + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    base_version = version if model.base_version is None else model.base_version
+    model.save(staging, version=version, base_version=base_version, source=source,
+               created=datetime.datetime.now(datetime.timezone.utc).isoformat())
+    os.replace(staging, path)
+    # Switching versions is a single atomic rename
+    with open(os.path.join(root, 'CURRENT.tmp'), 'w') as file:
+        file.write(str(version))
+    os.replace(os.path.join(root, 'CURRENT.tmp'), os.path.join(root, 'CURRENT'))
+    # Processes still mapping an old version keep their open files
+    for old in _store_versions(root)[:-keep]:
+        shutil.rmtree(os.path.join(root, f"v{old:06d}"), ignore_errors=True)
+    return version
+
+
+def load_factors(root=factor_store_path, mmap_mode='r'):
+    """Memory map the live version of a factor store.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the factor store.
+    mmap_mode : str, optional
+        Passed to `numpy.load`. None reads the arrays into memory.
+
+    Returns
+    -------
+    FactorModel
+        Factors of the live version.
+
+    """
+    version = current_version(root)
+    if version is None:
+        raise FileNotFoundError(f"No factors have been published to {root}.")
+    return FactorModel.load(os.path.join(root, f"v{version:06d}"), mmap_mode)
+
+
+def load_trained_factors(model_path="resources/models/tunedSVD_model.pkl", root=factor_store_path):
+    """Load the factors of the trained collaborative model.
+
+    The live version of the factor store is used when there is one.
+    Otherwise the pickled surprise SVD model is exported to the store
+    once, so that later loads can memory map it.
+
+    Parameters
+    ----------
+    model_path : str
+        Pickled `surprise.SVD` model.
+    root : str
+        Directory of the factor store.
+
+    Returns
+    -------
+    FactorModel
+        Factors of the trained model.
+
+    """
+    if current_version(root) is None:
+        with open(model_path, 'rb') as file:
+            model = pickle.load(file)
+        publish_factors(FactorModel.from_surprise(model), root, source=os.path.basename(model_path))
+    return load_factors(root)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a pickled SVD model to the factor store.")
+    parser.add_argument('model', nargs='?', default="resources/models/tunedSVD_model.pkl")
+    parser.add_argument('--store', default=factor_store_path)
+    args = parser.parse_args()
+
+    with open(args.model, 'rb') as file:
+        exported = FactorModel.from_surprise(pickle.load(file))
+    version = publish_factors(exported, args.store, source=os.path.basename(args.model))
+    print(f"Exported {args.model} as version {version} of: {args.store}")
+
+    from .fold_in import foldin_path, publish_fold_in
+    if os.path.exists(foldin_path):
+        # Ratings folded in since the last training are not in the exported model
+        _, version = publish_fold_in(root=args.store)
+        print(f"Folded the earlier fold-ins into version {version}.")
@@ -0,0 +1,309 @@
+"""
+
+    Online fold-in of new ratings into a trained factorisation model.
+
+    Description: Retraining the SVD model refits every factor. When only a
+    few users or movies receive new ratings, their own factors and biases
+    can instead be solved in closed form while everything else stays fixed:
+
+    - a user's [p_u, b_u] is the ridge regression of their ratings, less
+      the global mean and item biases, onto the fixed item factors;
+    - a new movie's [q_i, b_i] is the ridge regression of its ratings onto
+      the (updated) user factors. Movies added by an earlier fold-in are
+      solved again from all of their ratings whenever they get more.
+
+    The regularisation is weighted by the number of ratings of each row,
+    which matches the per-rating penalty surprise's SGD optimises.
+
+    Solved rows are published as a new version of the factor store, so the
+    app memory maps them like any other factors. Every rating folded in so
+    far is also kept in a small fold-in file next to the model, from which
+    rows are solved again when more of their ratings arrive. Folded-in
+    ratings are not part of `ratings.csv`, so after a retrain they are all
+    solved again against the new factors rather than dropped; `als.py`
+    and `factors.py` do so right after publishing. Run
+
+        python -m recommenders.fold_in new_ratings.csv
+
+    from the repository root, with userId, movieId and rating columns.
+
+"""
+# Script dependencies
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from .factors import factor_store_path, load_factors, load_trained_factors, publish_factors
+
+foldin_path = "resources/models/svd_foldin.npz"
+
+
+class FoldIn:
+    """Factor rows solved for new ratings, applied over a trained model.
+
+    Parameters
+    ----------
+    user_ids, pu, bu : numpy.ndarray
+        Folded-in users with their factors and biases.
+    item_ids, qi, bi : numpy.ndarray
+        Folded-in movies with their factors and biases.
+    ratings : Pandas DataFrame
+        Every rating folded in so far, needed to re-solve a user or movie
+        when more of its ratings arrive.
+    base_version : int, optional
+        Factor store version the rows were solved against.
+
+    """
+
+    def __init__(self, user_ids, pu, bu, item_ids, qi, bi, ratings, base_version=None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.pu, self.bu = pu, bu
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        self.qi, self.bi = qi, bi
+        self.ratings = ratings
+        self.base_version = base_version
+
+    @classmethod
+    def empty(cls, n_factors, base_version=None):
+        no_rows = np.zeros((0, n_factors))
+        return cls([], no_rows, np.zeros(0), [], no_rows, np.zeros(0),
+                   pd.DataFrame({'userId': [], 'movieId': [], 'rating': []}), base_version)
+
+    def apply(self, model):
+        """The model with the folded-in rows replacing or extending its own.
+
+        Parameters
+        ----------
+        model : recommenders.factors.FactorModel
+            The trained model.
+
+        Returns
+        -------
+        FactorModel
+            A new model. Only the factor arrays which change are copied,
+            the others stay memory mapped.
+
+        """
+        return model.overlay(self.user_ids, self.pu, self.bu, self.item_ids, self.qi, self.bi)
+
+    def merge(self, newer):
+        """Combine with a later fold-in, whose rows take precedence."""
+        keep_users = ~np.isin(self.user_ids, newer.user_ids)
+        keep_items = ~np.isin(self.item_ids, newer.item_ids)
+        return FoldIn(np.concatenate([self.user_ids[keep_users], newer.user_ids]),
+                      np.vstack([self.pu[keep_users], newer.pu]),
+                      np.concatenate([self.bu[keep_users], newer.bu]),
+                      np.concatenate([self.item_ids[keep_items], newer.item_ids]),
+                      np.vstack([self.qi[keep_items], newer.qi]),
+                      np.concatenate([self.bi[keep_items], newer.bi]),
+                      pd.concat([self.ratings, newer.ratings], ignore_index=True),
+                      self.base_version)
+
+    def save(self, path):
+        """Write the fold-in to the .npz file `path`."""
+        np.savez(path, user_ids=self.user_ids, pu=self.pu, bu=self.bu,
+                 item_ids=self.item_ids, qi=self.qi, bi=self.bi,
+                 rating_users=self.ratings['userId'].to_numpy(np.int64),
+                 rating_items=self.ratings['movieId'].to_numpy(np.int64),
+                 rating_values=self.ratings['rating'].to_numpy(np.float32),
+                 base_version=np.array(-1 if self.base_version is None else self.base_version))
+
+    @classmethod
+    def load(cls, path):
+        """Read a fold-in written with `save`."""
+        with np.load(path) as data:
+            ratings = pd.DataFrame({'userId': data['rating_users'],
+                                    'movieId': data['rating_items'],
+                                    'rating': data['rating_values']})
+            base_version = int(data['base_version']) if 'base_version' in data else -1
+            return cls(data['user_ids'], data['pu'], data['bu'],
+                       data['item_ids'], data['qi'], data['bi'], ratings,
+                       None if base_version < 0 else base_version)
+
+
+def solve_rows(fixed_factors, fixed_biases, observations, offset, reg=0.02):
+    """Solve the factors and bias of rows against fixed counterparts.
+
+    Parameters
+    ----------
+    fixed_factors : numpy.ndarray
+        Factors held fixed, e.g. the item factors when solving users.
+    fixed_biases : numpy.ndarray
+        Biases matching `fixed_factors`.
+    observations : list (tuple (numpy.ndarray, numpy.ndarray))
+        For each row to solve, the rows of `fixed_factors` it was rated
+        against and the ratings themselves.
+    offset : float
+        Global mean rating.
+    reg : float
+        Regularisation per rating.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Factors and biases of every solved row. Rows without observations
+        get zeros.
+
+    """
+    n_factors = fixed_factors.shape[1]
+    factors = np.zeros((len(observations), n_factors))
+    biases = np.zeros(len(observations))
+    identity = np.eye(n_factors + 1)
+    for row, (columns, values) in enumerate(observations):
+        if not len(columns):
+            continue
+        design = np.hstack([fixed_factors[columns], np.ones((len(columns), 1))])
+        target = values - offset - fixed_biases[columns]
+        gram = design.T @ design + reg * len(columns) * identity
+        solution = np.linalg.solve(gram, design.T @ target)
+        factors[row], biases[row] = solution[:-1], solution[-1]
+    return factors, biases
+
+
+def fold_in(model, history, new_ratings, reg=0.02, folded_items=()):
+    """Solve the rows of the users and new movies touched by new ratings.
+
+    Parameters
+    ----------
+    model : recommenders.factors.FactorModel
+        Current model, including earlier fold-ins.
+    history : Pandas DataFrame
+        Earlier ratings, with userId, movieId and rating columns. Only
+        those of the affected users and of the movies in `folded_items`
+        are used.
+    new_ratings : Pandas DataFrame
+        Ratings to fold in, with the same columns.
+    reg : float
+        Regularisation per rating.
+    folded_items : list (int)
+        Movies added by earlier fold-ins. They are solved again, from all
+        of their ratings, when new ratings of them arrive.
+
+    Returns
+    -------
+    FoldIn
+        Solved rows for every user in `new_ratings`, and for every movie
+        in `new_ratings` which the trained model does not know.
+
+    """
+    # Rows are solved at full precision, and quantised again when applied
+    model = model.dequantised()
+    new_ratings = new_ratings[['userId', 'movieId', 'rating']]
+    users = new_ratings['userId'].unique()
+    history = history[['userId', 'movieId', 'rating']]
+    # A re-rated movie keeps its latest rating
+    ratings = pd.concat([history[history['userId'].isin(users)], new_ratings],
+                        ignore_index=True).drop_duplicates(['userId', 'movieId'], keep='last')
+    item_rows = ratings['movieId'].map(model.item_row)
+    is_new = item_rows.isna() | ratings['movieId'].isin(folded_items)
+
+    # Users first, against the items the model already knows
+    known = ratings[~is_new].assign(row=item_rows[~is_new].astype(np.int64))
+    groups = known.groupby('userId')
+    user_obs = []
+    for user_id in users:
+        group = groups.get_group(user_id) if user_id in groups.groups else known.iloc[:0]
+        user_obs.append((group['row'].to_numpy(), group['rating'].to_numpy(np.float64)))
+    pu, bu = solve_rows(model.qi, model.bi, user_obs, model.global_mean, reg)
+
+    # Then the new items, against the updated users, from every rating they got
+    updated = FoldIn(users, pu, bu, [], np.zeros((0, model.n_factors)), np.zeros(0),
+                     new_ratings).apply(model)
+    item_ids = ratings.loc[is_new, 'movieId'].unique()
+    new_items = pd.concat([history[history['movieId'].isin(item_ids)], new_ratings],
+                          ignore_index=True).drop_duplicates(['userId', 'movieId'], keep='last')
+    new_items = new_items[new_items['movieId'].isin(item_ids)]
+    user_rows = new_items['userId'].map(updated.user_row)
+    new_items = new_items[user_rows.notna()].assign(row=user_rows.dropna().astype(np.int64))
+    groups = new_items.groupby('movieId')
+    item_obs = []
+    for item_id in item_ids:
+        group = groups.get_group(item_id)
+        item_obs.append((group['row'].to_numpy(), group['rating'].to_numpy(np.float64)))
+    qi, bi = solve_rows(updated.pu, updated.bu, item_obs, model.global_mean, reg)
+    return FoldIn(users, pu, bu, item_ids, qi, bi, new_ratings, model.base_version)
+
+
+def _history(store, ratings):
+    """Ratings of the users of `ratings` in the ratings store."""
+    history = []
+    for user_id in ratings['userId'].unique().tolist():
+        row = store.user_row(user_id)
+        if row is not None:
+            items, values = store.ratings_of_user(row)
+            history.append(pd.DataFrame({'userId': user_id, 'movieId': store.item_ids[items],
+                                         'rating': values}))
+    return history
+
+
+def publish_fold_in(new_ratings=None, root=factor_store_path, path=foldin_path, reg=0.02):
+    """Fold new ratings into the live factors and publish the result.
+
+    When the live factors have been retrained since the last fold-in, the
+    ratings folded in before are solved again along with the new ones.
+
+    Parameters
+    ----------
+    new_ratings : Pandas DataFrame, optional
+        Ratings to fold in, with userId, movieId and rating columns. None
+        only folds the earlier ratings into retrained factors.
+    root : str
+        Directory of the factor store.
+    path : str
+        Fold-in file holding every rating folded in so far.
+    reg : float
+        Regularisation per rating.
+
+    Returns
+    -------
+    tuple (FoldIn, int)
+        The rows solved for `new_ratings` and the published version.
+
+    """
+    from utils.ratings_store import load_ratings_store
+
+    live = load_factors(root)
+    empty = FoldIn.empty(live.n_factors, live.base_version)
+    if new_ratings is None:
+        new_ratings = empty.ratings
+    new_ratings = new_ratings[['userId', 'movieId', 'rating']]
+    previous = FoldIn.load(path) if os.path.exists(path) else empty
+    if previous.base_version not in (None, live.base_version):
+        # Rows solved against other factors do not fit a retrained model,
+        # but their ratings exist nowhere else
+        new_ratings = pd.concat([previous.ratings, new_ratings], ignore_index=True)
+        previous = empty
+    # The live version normally holds these rows already, applying them again is harmless
+    current = previous.apply(live)
+
+    # Earlier ratings come from ratings.csv and from previous fold-ins
+    history = pd.concat(_history(load_ratings_store(), new_ratings) + [previous.ratings],
+                        ignore_index=True)
+
+    # Movies added by earlier fold-ins are re-solved along with the new ones
+    update = fold_in(current, history, new_ratings, reg, previous.item_ids)
+    merged = previous.merge(update)
+    merged.save(path)
+    version = publish_factors(merged.apply(live), root,
+                              source=f"fold-in of {len(new_ratings)} ratings into version "
+                                     f"{live.version}")
+    return update, version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fold new ratings into the tuned SVD model.")
+    parser.add_argument('new_ratings', help="CSV file with userId, movieId and rating columns.")
+    parser.add_argument('--model', default="resources/models/tunedSVD_model.pkl")
+    parser.add_argument('--store', default=factor_store_path)
+    parser.add_argument('--reg', type=float, default=0.02)
+    parser.add_argument('--output', default=foldin_path)
+    args = parser.parse_args()
+
+    # Exports the pickled model to the factor store if it is still empty
+    load_trained_factors(args.model, args.store)
+    new_ratings = pd.read_csv(args.new_ratings, usecols=['userId', 'movieId', 'rating'])
+    update, version = publish_fold_in(new_ratings, args.store, args.output, args.reg)
+    print(f"Folded in {len(new_ratings)} ratings for {len(update.user_ids)} users and "
+          f"{len(update.item_ids)} new movies. Published factors as version {version} of: "
+          f"{args.store}")
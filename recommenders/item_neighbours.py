@@ -0,0 +1,171 @@
+"""
+
+    Precomputed item-item collaborative neighbour tables.
+
+    Description: For every movie in the ratings, the `k` most similar
+    movies by adjusted cosine similarity: ratings are centred on each
+    user's mean before comparing the rating columns of two movies. The
+    similarities are computed in blocks of items, so memory stays bounded
+    by `block_size` rows of dense scores, and the result is stored as
+    compact int32/float32 arrays.
+
+    Similarities backed by few common raters are shrunk towards zero by
+    n_common / (n_common + shrinkage), so that obscure movies rated by a
+    single user do not dominate every neighbour list.
+
+    Run `python -m recommenders.item_neighbours` from the repository root
+    to build the table for `resources/data/ratings.csv`.
+
+"""
+# Script dependencies
+import os
+import time
+import argparse
+import numpy as np
+from scipy import sparse
+
+from .similarity import normalise_rows, top_k, top_k_rows
+from utils.data_loader import data_path, file_fingerprint
+from utils.ratings_store import RatingsStore, load_ratings_store
+
+neighbours_path = "resources/models/item_neighbours.npz"
+
+
+class ItemNeighbours:
+    """The `k` nearest neighbours of every item.
+
+    Parameters
+    ----------
+    item_ids : numpy.ndarray
+        MovieLens Movie ID of each row.
+    neighbours : numpy.ndarray
+        Rows of the neighbours of each item, most similar first.
+    similarities : numpy.ndarray
+        Adjusted cosine similarity to each neighbour.
+    source : str, optional
+        Fingerprint of the ratings the table was built from.
+
+    """
+
+    def __init__(self, item_ids, neighbours, similarities, source=None):
+        self.item_ids = np.asarray(item_ids, dtype=np.int32)
+        self.neighbours = np.asarray(neighbours, dtype=np.int32)
+        self.similarities = np.asarray(similarities, dtype=np.float32)
+        self.source = source
+        self._rows = {item_id: row for row, item_id in enumerate(self.item_ids.tolist())}
+
+    @property
+    def k(self):
+        return self.neighbours.shape[1]
+
+    def item_row(self, item_id):
+        """Row of `item_id`, or None if it is not in the table."""
+        return self._rows.get(item_id)
+
+    def recommend(self, item_rows, top_n=10, allowed=None):
+        """Merge the neighbour lists of several items.
+
+        Parameters
+        ----------
+        item_rows : list (int)
+            Rows of the chosen items. They are never returned.
+        top_n : int
+            Number of items to return.
+        allowed : numpy.ndarray (bool), optional
+            Mask of the rows which may be recommended.
+
+        Returns
+        -------
+        numpy.ndarray
+            Rows of the items with the highest summed similarity to the
+            chosen items, best first.
+
+        """
+        candidates = self.neighbours[item_rows].ravel()
+        scores = self.similarities[item_rows].ravel()
+        rows, inverse = np.unique(candidates, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores)
+        excluded = np.isin(rows, item_rows)
+        if allowed is not None:
+            excluded |= ~allowed[rows]
+        return rows[top_k(totals, top_n, exclude=np.flatnonzero(excluded))]
+
+    def save(self, path):
+        """Write the table to the .npz file `path`."""
+        np.savez(path, item_ids=self.item_ids, neighbours=self.neighbours,
+                 similarities=self.similarities, source=np.array(self.source or ''))
+
+    @classmethod
+    def load(cls, path):
+        """Read a table written with `save`."""
+        with np.load(path) as data:
+            return cls(data['item_ids'], data['neighbours'], data['similarities'],
+                       str(data['source']) or None)
+
+
+def build_neighbour_table(store, k=50, block_size=512, shrinkage=10.0):
+    """Compute the top-k adjusted cosine neighbours of every item.
+
+    Parameters
+    ----------
+    store : utils.ratings_store.RatingsStore
+        Ratings to compare items by.
+    k : int
+        Neighbours kept per item.
+    block_size : int
+        Items scored at once. Peak memory grows with
+        `block_size * store.n_items`.
+    shrinkage : float
+        Number of common raters at which a similarity is halved.
+
+    Returns
+    -------
+    ItemNeighbours
+        The neighbour table, rows following `store.item_ids`.
+
+    """
+    # Centre every rating on the mean rating of its user
+    user_matrix = store.user_matrix()
+    counts = np.diff(user_matrix.indptr)
+    user_means = np.asarray(user_matrix.sum(axis=1)).ravel() / np.maximum(counts, 1)
+    centred = sparse.csr_matrix(
+        (user_matrix.data - np.repeat(user_means, counts).astype(np.float32),
+         user_matrix.indices, user_matrix.indptr), shape=user_matrix.shape)
+    items = normalise_rows(centred.T.tocsr())
+    items_t = items.T.tocsc()
+    raters = store.item_matrix().astype(bool).astype(np.float32)
+    raters_t = raters.T.tocsc()
+
+    k = min(k, store.n_items - 1)
+    neighbours = np.zeros((store.n_items, k), dtype=np.int32)
+    similarities = np.zeros((store.n_items, k), dtype=np.float32)
+    for start in range(0, store.n_items, block_size):
+        stop = min(start + block_size, store.n_items)
+        scores = (items[start:stop] @ items_t).toarray()
+        if shrinkage:
+            common = (raters[start:stop] @ raters_t).toarray()
+            scores *= common / (common + shrinkage)
+        # An item is not its own neighbour
+        scores[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        neighbours[start:stop], similarities[start:stop] = top_k_rows(scores, k)
+    return ItemNeighbours(store.item_ids, neighbours, similarities)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the item-item neighbour table.")
+    parser.add_argument('--ratings', help="Ratings to build from instead of the app's ratings.csv.")
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--shrinkage', type=float, default=10.0)
+    parser.add_argument('--output', default=neighbours_path)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    # Other ratings are read directly, leaving the app's ratings store alone
+    store = load_ratings_store() if args.ratings is None else RatingsStore.from_csv(args.ratings)
+    table = build_neighbour_table(store, args.k, args.block_size, args.shrinkage)
+    table.source = file_fingerprint(args.ratings or data_path('ratings.csv'))
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    table.save(args.output)
+    print(f"Built neighbours of {len(table.item_ids)} items in {time.perf_counter() - start:.1f}s. "
+          f"Saving table to: {args.output}")
@@ -0,0 +1,192 @@
+"""
+
+    Background execution of recommendation requests.
+
+    Description: Recommendations are computed by a shared pool of worker
+    threads instead of the Streamlit script thread, so a slow request does
+    not block the session. The scoring itself runs in numpy and scipy,
+    which release the GIL, and every worker shares the models already
+    loaded in the process. The pool is warmed on creation by loading the
+    models in the background.
+
+    - A job reports the stage it has reached (resolving titles, scoring,
+      ranking) through `stage`, which the recommenders call as they go.
+    - Submitting a request which is already queued or running returns the
+      existing job, so repeated clicks do not duplicate work.
+    - A job which nobody waits for any more is cancelled: before it starts
+      if it is still queued, or at its next stage otherwise.
+
+"""
+# Script dependencies
+import time
+import itertools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from .result_cache import favourites_key
+from utils.tracing import trace
+
+STAGES = ['queued', 'resolving titles', 'scoring', 'ranking', 'done']
+
+# Job of the current worker thread, if any
+_current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job which has been cancelled."""
+
+
+def stage(name):
+    """Report that the current job has reached stage `name`.
+
+    Outside a job this does nothing. Inside a cancelled job it raises
+    `JobCancelled`, which stops the job at the stage boundary.
+    """
+    job = _current_job.get()
+    if job is not None:
+        if job.cancel_requested.is_set():
+            raise JobCancelled(job.key)
+        job.stage = name
+
+
+class Job:
+    """A recommendation request running in the pool.
+
+    Attributes
+    ----------
+    key : tuple
+        Algorithm, normalised favourites and `top_n` of the request.
+    stage : str
+        Last stage reached, one of `STAGES`.
+    subscribers : int
+        Sessions waiting for the result.
+
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, key):
+        self.id = next(self._ids)
+        self.key = key
+        self.stage = 'queued'
+        self.subscribers = 1
+        self.cancel_requested = threading.Event()
+        self.submitted = time.monotonic()
+        self.future = None
+
+    @property
+    def progress(self):
+        """Share of the stages completed, between 0 and 1."""
+        return STAGES.index(self.stage) / (len(STAGES) - 1)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.submitted
+
+    def done(self):
+        return self.future.done()
+
+    def cancelled(self):
+        return self.cancel_requested.is_set()
+
+    def result(self):
+        """The recommended titles, raising the job's error if it failed."""
+        return self.future.result()
+
+
+class JobPool:
+    """Worker threads computing recommendations.
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of worker threads.
+    warm_up : list (callable)
+        Functions loading models, run in the background straight away.
+
+    """
+
+    def __init__(self, max_workers=4, warm_up=()):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='recommender')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        for load in warm_up:
+            self._executor.submit(load)
+
+    def submit(self, algorithm, recommend, movie_list, top_n=10):
+        """Start a recommendation, or join the identical one in progress.
+
+        Parameters
+        ----------
+        algorithm : str
+            Name of the recommender, part of the deduplication key.
+        recommend : callable
+            Recommender taking `movie_list` and `top_n`.
+        movie_list : list (str)
+            Favourite movies.
+        top_n : int
+            Number of recommendations.
+
+        Returns
+        -------
+        Job
+            Handle to poll for the stage and result.
+
+        """
+        key = (algorithm, favourites_key(movie_list), top_n)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not job.done() and not job.cancelled():
+                job.subscribers += 1
+                return job
+            job = Job(key)
+            self._jobs[key] = job
+            job.future = self._executor.submit(self._run, job, recommend, list(movie_list), top_n)
+        return job
+
+    def _run(self, job, recommend, movie_list, top_n):
+        token = _current_job.set(job)
+        try:
+            stage('resolving titles')
+            with trace(job.key[0], favourites=len(movie_list), top_n=top_n,
+                       queued_ms=job.elapsed * 1000):
+                result = recommend(movie_list, top_n)
+            job.stage = 'done'
+            return result
+        finally:
+            _current_job.reset(token)
+            with self._lock:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+    def release(self, job):
+        """Stop waiting for a job, cancelling it if nobody else is."""
+        with self._lock:
+            job.subscribers -= 1
+            if job.subscribers > 0 or job.done():
+                return
+            job.cancel_requested.set()
+            if job.future.cancel() and self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+
+def get_job_pool(max_workers=4):
+    """Return the process-wide job pool, creating and warming it once."""
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            from .content_based import load_content_index
+            from .collaborative_based import load_item_neighbours
+            from utils.ratings_store import load_ratings_store
+            _job_pool = JobPool(max_workers, warm_up=[load_content_index, load_ratings_store,
+                                                      load_item_neighbours])
+    return _job_pool
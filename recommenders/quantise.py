@@ -0,0 +1,290 @@
+"""
+
+    Reduced precision latent factors for serving.
+
+    Description: The user and item factors of the tuned SVD model are
+    float64, eight bytes per value. Scoring only needs a ranking, so they
+    can be stored as
+
+    - float16: two bytes per value, or
+    - int8 with one float32 scale per row: one byte per value. Each row is
+      divided by its largest absolute value and rounded to [-127, 127].
+
+    `QuantisedFactorModel` keeps the reduced arrays, also in the factor
+    store, and scores on them directly: the chosen item's row is decoded
+    once and users are decoded a chunk at a time into float32. Biases stay
+    at full precision.
+
+    Run `python -m recommenders.quantise` from the repository root to
+    compare each precision with the original on RMSE, top-k overlap,
+    memory and scoring throughput, and `--publish int8` to publish a
+    quantised copy of the live factors, folded-in ratings included.
+
+"""
+# Script dependencies
+import os
+import time
+import argparse
+import numpy as np
+
+from .factors import FactorModel, _overlay, _read_manifest, factor_store_path, \
+    load_factors, publish_factors
+from .similarity import top_k
+
+PRECISIONS = ['float16', 'int8']
+
+
+def quantise_rows(factors, precision):
+    """Encode factor rows at a reduced precision.
+
+    Parameters
+    ----------
+    factors : numpy.ndarray
+        Full precision factors, one row per user or item.
+    precision : str
+        'float16' or 'int8'.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        The encoded rows and, for int8, the scale of every row (None for
+        float16).
+
+    """
+    factors = np.asarray(factors)
+    if precision == 'float16':
+        return factors.astype(np.float16), None
+    if precision != 'int8':
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}.")
+    scales = np.abs(factors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.rint(factors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantise_rows(codes, scales, rows=slice(None)):
+    """Decode rows of quantised factors to float32."""
+    decoded = np.asarray(codes[rows], dtype=np.float32)
+    if scales is not None:
+        decoded *= scales[rows][..., None]
+    return decoded
+
+
+class QuantisedFactorModel(FactorModel):
+    """A factorisation model with reduced precision factors.
+
+    Parameters
+    ----------
+    pu, qi : numpy.ndarray
+        Encoded user and item factors, see `quantise_rows`.
+    bu, bi, global_mean, user_ids, item_ids, rating_scale, version, base_version
+        As for `FactorModel`.
+    precision : str
+        'float16' or 'int8'.
+    pu_scale, qi_scale : numpy.ndarray, optional
+        Row scales of int8 factors.
+    chunk_size : int
+        Users decoded at once when scoring an item.
+
+    """
+
+    def __init__(self, pu, qi, bu, bi, global_mean, user_ids, item_ids, rating_scale=(0.5, 5.0),
+                 version=None, precision='int8', pu_scale=None, qi_scale=None, chunk_size=32768,
+                 base_version=None):
+        super().__init__(pu, qi, bu, bi, global_mean, user_ids, item_ids, rating_scale, version,
+                         base_version)
+        self.precision = precision
+        self.pu_scale = pu_scale
+        self.qi_scale = qi_scale
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_model(cls, model, precision):
+        """Quantise the factors of a full precision model.
+
+        The copy keeps the model's `base_version`: a change of precision is
+        not a retrain, so ratings folded into the model stay valid.
+
+        """
+        model = model.dequantised()
+        pu, pu_scale = quantise_rows(model.pu, precision)
+        qi, qi_scale = quantise_rows(model.qi, precision)
+        return cls(pu, qi, model.bu, model.bi, model.global_mean, model.user_ids, model.item_ids,
+                   model.rating_scale, model.version, precision, pu_scale, qi_scale,
+                   base_version=model.base_version)
+
+    @property
+    def nbytes(self):
+        """Memory taken by the factors and their scales."""
+        return sum(array.nbytes for array in [self.pu, self.qi, self.pu_scale, self.qi_scale]
+                   if array is not None)
+
+    def save(self, path, **manifest):
+        super().save(path, precision=self.precision, **manifest)
+        if self.precision == 'int8':
+            np.save(os.path.join(path, 'pu_scale.npy'), self.pu_scale)
+            np.save(os.path.join(path, 'qi_scale.npy'), self.qi_scale)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        manifest = _read_manifest(path)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ['pu', 'qi', 'bu', 'bi', 'user_ids', 'item_ids']}
+        if manifest['precision'] == 'int8':
+            for name in ['pu_scale', 'qi_scale']:
+                arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+        return cls(global_mean=manifest['global_mean'], rating_scale=manifest['rating_scale'],
+                   version=manifest.get('version'), precision=manifest['precision'],
+                   base_version=manifest.get('base_version'), **arrays)
+
+    def dequantised(self):
+        return FactorModel(dequantise_rows(self.pu, self.pu_scale),
+                           dequantise_rows(self.qi, self.qi_scale), self.bu, self.bi,
+                           self.global_mean, self.user_ids, self.item_ids, self.rating_scale,
+                           self.version, self.base_version)
+
+    def overlay(self, user_ids, pu, bu, item_ids, qi, bi):
+        pu, pu_scale = quantise_rows(pu, self.precision)
+        qi, qi_scale = quantise_rows(qi, self.precision)
+        user_arrays = [self.pu, self.bu] + ([self.pu_scale] if pu_scale is not None else [])
+        item_arrays = [self.qi, self.bi] + ([self.qi_scale] if qi_scale is not None else [])
+        user_arrays, user_ids = _overlay(user_arrays, self.user_ids, self.user_row,
+                                         [pu, bu, pu_scale], user_ids)
+        item_arrays, item_ids = _overlay(item_arrays, self.item_ids, self.item_row,
+                                         [qi, bi, qi_scale], item_ids)
+        return QuantisedFactorModel(user_arrays[0], item_arrays[0], user_arrays[1], item_arrays[1],
+                                    self.global_mean, user_ids, item_ids, self.rating_scale,
+                                    self.version, self.precision,
+                                    *(arrays[2] if len(arrays) > 2 else None
+                                      for arrays in [user_arrays, item_arrays]),
+                                    chunk_size=self.chunk_size, base_version=self.base_version)
+
+    def predict_rows(self, user_rows, item_rows):
+        dots = np.einsum('ij,ij->i', dequantise_rows(self.pu, self.pu_scale, user_rows),
+                         dequantise_rows(self.qi, self.qi_scale, item_rows))
+        estimates = self.global_mean + self.bu[user_rows] + self.bi[item_rows] + dots
+        return np.clip(estimates, *self.rating_scale)
+
+    def predict_items(self, item_ids):
+        rows = [self.item_row(item_id) for item_id in item_ids]
+        known = [i for i, row in enumerate(rows) if row is not None]
+        estimates = np.repeat(self.global_mean + np.asarray(self.bu, dtype=np.float64)[:, None],
+                              len(rows), axis=1)
+        if known:
+            known_rows = [rows[i] for i in known]
+            items = dequantise_rows(self.qi, self.qi_scale, known_rows)
+            dots = np.empty((len(self.user_ids), len(known)), dtype=np.float32)
+            for start in range(0, len(dots), self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                dots[chunk] = np.asarray(self.pu[chunk], dtype=np.float32) @ items.T
+            if self.pu_scale is not None:
+                dots *= self.pu_scale[:, None]
+            estimates[:, known] += self.bi[known_rows] + dots
+        return np.clip(estimates, *self.rating_scale)
+
+    def predict_item(self, item_id):
+        estimates = self.global_mean + np.asarray(self.bu, dtype=np.float64)
+        row = self.item_row(item_id)
+        if row is not None:
+            item = dequantise_rows(self.qi, self.qi_scale, row)
+            dots = np.empty(len(self.user_ids), dtype=np.float32)
+            for start in range(0, len(dots), self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                dots[chunk] = np.asarray(self.pu[chunk], dtype=np.float32) @ item
+            if self.pu_scale is not None:
+                dots *= self.pu_scale
+            estimates += self.bi[row] + dots
+        return np.clip(estimates, *self.rating_scale)
+
+
+def quantisation_report(model, store, precisions=PRECISIONS, n_items=100, k=10,
+                        n_ratings=200000, seed=42):
+    """Compare quantised copies of a model with the original.
+
+    Parameters
+    ----------
+    model : FactorModel
+        Full precision model.
+    store : utils.ratings_store.RatingsStore
+        Ratings the RMSE is measured on.
+    precisions : list (str)
+        Precisions to compare.
+    n_items : int
+        Items whose top `k` users are compared and timed.
+    k : int
+        Length of the compared rankings.
+    n_ratings : int
+        Ratings sampled for the RMSE.
+    seed : int
+        Seed of the samples.
+
+    Returns
+    -------
+    list (dict)
+        One row per precision, the original first, with the RMSE on the
+        sampled ratings, the RMSE against the original predictions, the
+        mean overlap of the top `k` users, the factor memory in MB and the
+        items scored per second.
+
+    """
+    model = model.dequantised()
+    rng = np.random.default_rng(seed)
+    # Ratings whose user and item the model knows, in model rows
+    sample = rng.choice(store.n_ratings, min(n_ratings, store.n_ratings), replace=False)
+    store_users = np.searchsorted(store.user_indptr, sample, side='right') - 1
+    user_rows = np.array([model.user_row(u) for u in store.user_ids[store_users].tolist()],
+                         dtype=float)
+    item_rows = np.array([model.item_row(i) for i in store.item_ids[store.user_items[sample]].tolist()],
+                         dtype=float)
+    known = ~np.isnan(user_rows) & ~np.isnan(item_rows)
+    user_rows, item_rows = user_rows[known].astype(np.int64), item_rows[known].astype(np.int64)
+    actual = store.user_ratings[sample][known]
+    items = model.item_ids[rng.choice(len(model.item_ids), min(n_items, len(model.item_ids)),
+                                      replace=False)].tolist()
+
+    reference = model.predict_rows(user_rows, item_rows)
+    reference_top = [set(top_k(model.predict_item(item), k).tolist()) for item in items]
+    report = []
+    for precision in ['float64'] + list(precisions):
+        candidate = model if precision == 'float64' else \
+            QuantisedFactorModel.from_model(model, precision)
+        predictions = candidate.predict_rows(user_rows, item_rows)
+        start = time.perf_counter()
+        scores = [candidate.predict_item(item) for item in items]
+        elapsed = time.perf_counter() - start
+        overlap = np.mean([len(expected & set(top_k(score, k).tolist())) / k
+                           for expected, score in zip(reference_top, scores)])
+        nbytes = candidate.nbytes if precision != 'float64' else candidate.pu.nbytes + candidate.qi.nbytes
+        report.append({'precision': precision,
+                       'rmse': float(np.sqrt(np.mean((predictions - actual) ** 2))),
+                       'rmse_vs_float64': float(np.sqrt(np.mean((predictions - reference) ** 2))),
+                       f'top{k}_overlap': float(overlap),
+                       'factor_mb': nbytes / 2 ** 20,
+                       'items_per_second': len(items) / elapsed})
+    return report
+
+
+if __name__ == '__main__':
+    from utils.ratings_store import load_ratings_store
+
+    parser = argparse.ArgumentParser(description="Compare or publish quantised SVD factors.")
+    parser.add_argument('--store', default=factor_store_path)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--ratings', type=int, default=200000)
+    parser.add_argument('--publish', choices=PRECISIONS,
+                        help="Publish the live factors at this precision instead of reporting.")
+    args = parser.parse_args()
+
+    live = load_factors(args.store)
+    if args.publish:
+        version = publish_factors(QuantisedFactorModel.from_model(live, args.publish), args.store,
+                                  source=f"{args.publish} of version {live.version}")
+        print(f"Published {args.publish} factors as version {version} of: {args.store}")
+    else:
+        for row in quantisation_report(live, load_ratings_store(), n_items=args.items, k=args.k,
+                                       n_ratings=args.ratings):
+            print(f"{row['precision']:>8}: RMSE {row['rmse']:.4f} "
+                  f"(vs float64 {row['rmse_vs_float64']:.4f}), "
+                  f"top-{args.k} overlap {row[f'top{args.k}_overlap']:.3f}, "
+                  f"factors {row['factor_mb']:.1f} MB, {row['items_per_second']:.1f} items/s")
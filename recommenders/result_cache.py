@@ -0,0 +1,137 @@
+"""
+
+    In-process cache of recommendation results.
+
+    Description: The app offers three fixed ranges of titles to choose
+    favourites from, so the same favourite sets are requested again and
+    again. `ResultCache` remembers the titles recommended for each
+    (algorithm, favourites, top_n) key:
+
+    - favourites are normalised to a sorted tuple, so the order in which
+      they were picked does not matter;
+    - entries are evicted least recently used first once `max_entries` is
+      reached, and optionally expire `ttl` seconds after being stored;
+    - every entry records the version of the model or index which produced
+      it, and is discarded as soon as that version changes;
+    - hits, misses, expiries and evictions are counted for diagnostics.
+
+    `cached_recommendations` applies the cache to a recommender function
+    without changing its signature.
+
+"""
+# Script dependencies
+import time
+import functools
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Thread-safe LRU cache with optional expiry and version checks.
+
+    Parameters
+    ----------
+    max_entries : int
+        Number of results kept.
+    ttl : float, optional
+        Seconds after which a result expires. Results never expire by
+        default.
+    clock : callable
+        Returns the current time in seconds.
+
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version=None):
+        """The result stored for `key` by `version`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_version, stored_at = entry
+                if stored_version != version or (self.ttl is not None
+                                                 and self.clock() - stored_at > self.ttl):
+                    del self._entries[key]
+                    self.expired += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value, version=None):
+        """Store the result for `key` produced by `version`."""
+        with self._lock:
+            self._entries[key] = (value, version, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        """Drop every result, keeping the counters."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Counters and size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                    'evicted': self.evicted, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+# Shared by every recommender, the algorithm is part of each key.
+result_cache = ResultCache()
+
+
+def favourites_key(movie_list):
+    """Normalised favourite titles, independent of their order."""
+    return tuple(sorted(title.strip() for title in movie_list))
+
+
+def cached_recommendations(algorithm, version, cache=None):
+    """Decorate a recommender so that repeated requests hit `cache`.
+
+    Parameters
+    ----------
+    algorithm : str
+        Name of the recommender, part of every key.
+    version : callable
+        Returns the version of the model or index currently in use. Results
+        produced by other versions are not returned.
+    cache : ResultCache, optional
+        Defaults to the shared `result_cache`.
+
+    Returns
+    -------
+    callable
+        Decorator for functions taking `movie_list` and `top_n`. Errors are
+        not cached.
+
+    """
+    def decorator(recommend):
+        @functools.wraps(recommend)
+        def wrapper(movie_list, top_n=10):
+            store = result_cache if cache is None else cache
+            key = (algorithm, favourites_key(movie_list), top_n)
+            current = version()
+            recommended = store.get(key, current)
+            if recommended is None:
+                recommended = recommend(movie_list, top_n)
+                store.put(key, tuple(recommended), current)
+            return list(recommended)
+        wrapper.uncached = recommend
+        return wrapper
+    return decorator
@@ -0,0 +1,216 @@
+"""
+
+    Sparse top-k similarity search over item feature matrices.
+
+    Description: Helpers used by the recommenders to score a handful of
+    query items against a whole catalog without materialising the dense
+    item-by-item similarity matrix. Feature rows are L2-normalised once so
+    that cosine similarity reduces to a sparse dot product, and only the
+    best `k` candidates are ever sorted.
+
+"""
+# Script dependencies
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+def normalise_rows(features, dtype=np.float32):
+    """L2-normalise the rows of a feature matrix.
+
+    Parameters
+    ----------
+    features : scipy.sparse matrix
+        Item features with one row per item.
+    dtype : numpy dtype
+        Floating point type of the returned matrix.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Row-normalised copy of `features`. Empty rows stay empty.
+
+    """
+    features = sparse.csr_matrix(features, dtype=dtype)
+    return normalize(features, norm='l2', axis=1, copy=False)
+
+
+def query_scores(features, query_rows, weights=None):
+    """Combined cosine similarity of a set of query rows to every item.
+
+    Parameters
+    ----------
+    features : scipy.sparse.csr_matrix
+        Row-normalised item features, see `normalise_rows`.
+    query_rows : list (int)
+        Rows of `features` to score against the catalog.
+    weights : list (float), optional
+        Weight of each query row. Rows are weighted equally by default.
+
+    Returns
+    -------
+    numpy.ndarray
+        Weighted sum of the similarities of each query row, one score per
+        item in `features`.
+
+    """
+    query_rows = np.asarray(query_rows, dtype=np.int64)
+    if weights is None:
+        weights = np.ones(len(query_rows), dtype=features.dtype)
+    # Summing the query rows first costs a single sparse product
+    profile = sparse.csr_matrix(
+        (np.asarray(weights, dtype=features.dtype), (np.zeros(len(query_rows)), query_rows)),
+        shape=(1, features.shape[0]))
+    profile = profile @ features
+    return np.asarray((features @ profile.T).todense()).ravel()
+
+
+def top_k(scores, k, exclude=None):
+    """Indices of the `k` highest scores, best first.
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+        One score per candidate.
+    k : int
+        Number of candidates to return.
+    exclude : list (int), optional
+        Candidates which may never be returned.
+
+    Returns
+    -------
+    numpy.ndarray
+        Candidate indices ordered by descending score. Ties are broken by
+        the lower index so that results are deterministic.
+
+    """
+    if exclude is not None and len(exclude):
+        scores = scores.astype(np.float64, copy=True)
+        scores[np.asarray(exclude, dtype=np.int64)] = -np.inf
+    k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        # argpartition picks arbitrarily among scores tied with the k-th,
+        # so every candidate at least as good is kept until the sort
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:k]]
+
+
+def top_k_rows(scores, k):
+    """`top_k` applied to every row of a score matrix.
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+        Scores with one row per query and one column per candidate.
+    k : int
+        Number of candidates to return per row, at most the number of
+        columns.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Candidate columns of every row ordered by descending score, with
+        ties broken by the lower column, and their scores.
+
+    """
+    if k <= 0:
+        return (np.empty((len(scores), 0), dtype=np.int64),
+                np.empty((len(scores), 0), dtype=scores.dtype))
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        # As in `top_k`, rows with more scores tied at the k-th than fit
+        # are redone with every candidate at least as good
+        kth = np.take_along_axis(scores, candidates[:, k - 1:], axis=1)
+        for row in np.flatnonzero((scores >= kth).sum(axis=1) > k).tolist():
+            row_candidates = np.flatnonzero(scores[row] >= kth[row, 0])
+            order = np.lexsort((row_candidates, -scores[row, row_candidates]))
+            candidates[row] = row_candidates[order[:k]]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.lexsort((candidates, -candidate_scores), axis=1)
+    return (np.take_along_axis(candidates, order, axis=1),
+            np.take_along_axis(candidate_scores, order, axis=1))
+
+
+def top_k_similar(features, query_rows, k=10, weights=None):
+    """The `k` items most similar to a set of query items.
+
+    Parameters
+    ----------
+    features : scipy.sparse.csr_matrix
+        Row-normalised item features, see `normalise_rows`.
+    query_rows : list (int)
+        Rows of `features` to recommend from. They are never returned.
+    k : int
+        Number of similar items to return.
+    weights : list (float), optional
+        Weight of each query row.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Rows of the most similar items, best first, and their scores.
+
+    """
+    scores = query_scores(features, query_rows, weights)
+    rows = top_k(scores, k, exclude=query_rows)
+    return rows, scores[rows]
+
+
+def batch_top_k_similar(features, query_sets, k=10, max_bytes=256 * 2 ** 20):
+    """`top_k_similar` for many sets of query rows at once.
+
+    Every query set becomes one row of a sparse profile matrix, so all
+    profiles are built with a single sparse product. Profiles are then
+    scored against the catalog in chunks of sparse-dense products, sized
+    so that each dense block stays within `max_bytes`.
+
+    Parameters
+    ----------
+    features : scipy.sparse.csr_matrix
+        Row-normalised item features, see `normalise_rows`.
+    query_sets : list (list (int))
+        Rows of `features` to recommend from, one list per query.
+    k : int
+        Number of similar items to return per query.
+    max_bytes : int
+        Memory budget of each dense block of profiles and scores.
+
+    Returns
+    -------
+    list (tuple (numpy.ndarray, numpy.ndarray))
+        Rows of the most similar items, best first, and their scores for
+        every query set.
+
+    """
+    n_items, n_features = features.shape
+    query_ids = np.repeat(np.arange(len(query_sets)), [len(rows) for rows in query_sets])
+    query_rows = np.fromiter((row for rows in query_sets for row in rows), dtype=np.int64,
+                             count=len(query_ids))
+    selection = sparse.csr_matrix(
+        (np.ones(len(query_rows), dtype=features.dtype), (query_ids, query_rows)),
+        shape=(len(query_sets), n_items))
+    profiles = (selection @ features).tocsr()
+
+    row_bytes = features.dtype.itemsize * (n_items + n_features)
+    chunk_size = max(1, max_bytes // row_bytes)
+    k = min(k, n_items)
+    results = []
+    for start in range(0, len(query_sets), chunk_size):
+        stop = min(start + chunk_size, len(query_sets))
+        scores = np.ascontiguousarray((features @ profiles[start:stop].toarray().T).T)
+        # Chosen items may never be recommended back
+        chunk = selection[start:stop].tocoo()
+        scores[chunk.row, chunk.col] = -np.inf
+        candidates, candidate_scores = top_k_rows(scores, k)
+        for rows, row_scores in zip(candidates, candidate_scores):
+            finite = np.isfinite(row_scores)
+            results.append((rows[finite].astype(np.int64), row_scores[finite]))
+    return results
@@ -0,0 +1,315 @@
+"""
+
+    Parallel hyperparameter search for the collaborative SVD model.
+
+    Description: Tunes the `surprise.SVD` hyperparameters hard-coded in
+    `resources/models/train_colbased.py` by k-fold cross-validation.
+
+    - grid: every combination of `GRID`;
+    - random: configurations sampled from `SPACE`;
+    - halving: successive halving of random configurations, where each
+      rung trains the survivors for `eta` times more epochs than the last
+      and keeps the best `1 / eta` of them.
+
+    Grid and random search evaluate one fold at a time, and drop a
+    configuration as soon as its mean RMSE so far is `prune_margin` worse
+    than the best one, so weak configurations are not trained on every
+    fold.
+
+    The ratings are shuffled and split into folds once, and saved as .npy
+    files in a scratch directory which the worker processes memory map,
+    so every trial reuses the same split without copying the ratings.
+    Each worker builds the surprise trainset of a fold once and keeps it.
+    Every trial's parameters, metrics and time are appended to a JSON
+    lines results file as it completes.
+
+    Run `python -m recommenders.tuning --method halving` from the
+    repository root.
+
+"""
+# Script dependencies
+import os
+import json
+import time
+import argparse
+import itertools
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .factors import FactorModel
+
+results_path = "resources/models/tuning_results.jsonl"
+
+# Values tried by grid search
+GRID = {'n_factors': [50, 100, 200],
+        'lr_all': [0.002, 0.005, 0.01],
+        'reg_all': [0.02, 0.05, 0.1],
+        'n_epochs': [20, 40]}
+# Ranges sampled by random search and successive halving, log-uniformly
+SPACE = {'n_factors': (20, 300),
+         'lr_all': (0.001, 0.02),
+         'reg_all': (0.005, 0.2),
+         'n_epochs': (10, 60)}
+_INTEGERS = {'n_factors', 'n_epochs'}
+
+# Memory-mapped folds of the current worker process
+_workspace = None
+
+
+def grid_configs(grid=GRID):
+    """Every combination of the values in `grid`."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def random_configs(n, space=SPACE, seed=42):
+    """`n` configurations sampled log-uniformly from the ranges in `space`."""
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(n):
+        config = {}
+        for name, (low, high) in space.items():
+            value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            config[name] = int(round(value)) if name in _INTEGERS else round(value, 5)
+        configs.append(config)
+    return configs
+
+
+def split_folds(ratings, workdir, n_folds=5, seed=42):
+    """Shuffle the ratings and save them, with a fold number each, to `workdir`."""
+    order = np.random.default_rng(seed).permutation(len(ratings))
+    columns = {'users': ratings['userId'].to_numpy(np.int64)[order],
+               'items': ratings['movieId'].to_numpy(np.int64)[order],
+               'ratings': ratings['rating'].to_numpy(np.float32)[order],
+               'folds': (np.arange(len(ratings)) % n_folds).astype(np.int8)}
+    for name, column in columns.items():
+        np.save(os.path.join(workdir, f"{name}.npy"), column)
+    with open(os.path.join(workdir, 'scale.json'), 'w') as file:
+        json.dump([float(ratings['rating'].min()), float(ratings['rating'].max())], file)
+
+
+def _open_workspace(workdir):
+    global _workspace
+    if _workspace is None or _workspace[0] != workdir:
+        arrays = {name: np.load(os.path.join(workdir, f"{name}.npy"), mmap_mode='r')
+                  for name in ['users', 'items', 'ratings', 'folds']}
+        with open(os.path.join(workdir, 'scale.json')) as file:
+            arrays['scale'] = tuple(json.load(file))
+        _workspace = (workdir, arrays, {})
+    return _workspace[1], _workspace[2]
+
+
+def _fold(workdir, fold):
+    """Trainset and test arrays of one fold, built once per worker."""
+    import surprise
+
+    arrays, trainsets = _open_workspace(workdir)
+    if fold not in trainsets:
+        test = np.asarray(arrays['folds']) == fold
+        train = pd.DataFrame({'userId': arrays['users'][~test], 'movieId': arrays['items'][~test],
+                              'rating': arrays['ratings'][~test]})
+        reader = surprise.Reader(rating_scale=arrays['scale'])
+        trainset = surprise.Dataset.load_from_df(train, reader).build_full_trainset()
+        trainsets[fold] = (trainset, arrays['users'][test], arrays['items'][test],
+                           arrays['ratings'][test])
+    return trainsets[fold]
+
+
+def score_fold(model, users, items, ratings):
+    """RMSE and MAE of a fitted SVD model, predicting like `SVD.predict`."""
+    factors = FactorModel.from_surprise(model)
+    user_rows = pd.Series(users).map(factors.user_row).to_numpy(dtype=float)
+    item_rows = pd.Series(items).map(factors.item_row).to_numpy(dtype=float)
+    known_user, known_item = ~np.isnan(user_rows), ~np.isnan(item_rows)
+    user_rows = np.where(known_user, user_rows, 0).astype(np.int64)
+    item_rows = np.where(known_item, item_rows, 0).astype(np.int64)
+    # Unknown users and items contribute neither a bias nor factors
+    estimates = (factors.global_mean + np.where(known_user, factors.bu[user_rows], 0)
+                 + np.where(known_item, factors.bi[item_rows], 0)
+                 + np.where(known_user & known_item,
+                            np.einsum('ij,ij->i', factors.pu[user_rows], factors.qi[item_rows]), 0))
+    errors = np.clip(estimates, *factors.rating_scale) - ratings
+    return float(np.sqrt(np.mean(errors ** 2))), float(np.mean(np.abs(errors)))
+
+
+def run_trial(workdir, fold, config, seed=0):
+    """Fit SVD with `config` on all folds but `fold`, and score it on `fold`."""
+    from surprise import SVD
+
+    trainset, users, items, ratings = _fold(workdir, fold)
+    start = time.perf_counter()
+    model = SVD(init_std_dev=0.05, random_state=seed, **config).fit(trainset)
+    fitted = time.perf_counter()
+    rmse, mae = score_fold(model, users, items, ratings)
+    return {'config': config, 'fold': fold, 'rmse': rmse, 'mae': mae,
+            'fit_seconds': fitted - start, 'test_seconds': time.perf_counter() - fitted}
+
+
+class _Search:
+    """Runs trials on a pool and logs them, for the search strategies below."""
+
+    def __init__(self, workdir, n_folds, pool, log, method):
+        self.workdir, self.n_folds, self.pool = workdir, n_folds, pool
+        self.log, self.method = log, method
+        self.n_trials = 0
+
+    def run(self, trials, **extra):
+        """Run (config id, config, fold) trials, returning RMSEs by config id."""
+        tasks = [(self.workdir, fold, config) for _, config, fold in trials]
+        if self.pool is None:
+            results = zip(trials, (run_trial(*task) for task in tasks))
+        else:
+            futures = {self.pool.submit(run_trial, *task): trial
+                       for trial, task in zip(trials, tasks)}
+            results = ((futures[future], future.result()) for future in as_completed(futures))
+        scores = {}
+        for (config_id, _, _), result in results:
+            self.n_trials += 1
+            record = dict(trial=self.n_trials, method=self.method, config_id=config_id,
+                          **extra, **result)
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+            scores.setdefault(config_id, []).append(result['rmse'])
+        return scores
+
+
+def fold_pruned_search(search, configs, prune_margin=0.01):
+    """Evaluate configurations fold by fold, dropping those falling behind.
+
+    Returns
+    -------
+    dict
+        Mean RMSE of every configuration, over the folds it was run on,
+        and whether it completed all of them.
+
+    """
+    alive = dict(enumerate(configs))
+    scores = {config_id: [] for config_id in alive}
+    for fold in range(search.n_folds):
+        trials = [(config_id, config, fold) for config_id, config in alive.items()]
+        for config_id, rmses in search.run(trials, stage=fold).items():
+            scores[config_id] += rmses
+        means = {config_id: np.mean(scores[config_id]) for config_id in alive}
+        best = min(means.values())
+        alive = {config_id: config for config_id, config in alive.items()
+                 if means[config_id] <= best + prune_margin}
+    return {config_id: {'config': configs[config_id], 'rmse': float(np.mean(rmses)),
+                        'complete': config_id in alive}
+            for config_id, rmses in scores.items()}
+
+
+def successive_halving(search, configs, max_epochs=40, eta=3):
+    """Train more epochs on ever fewer configurations.
+
+    Every rung trains the surviving configurations, with `n_epochs` set
+    by the rung, on all folds and keeps the best `1 / eta` of them. The
+    last rung trains for `max_epochs`.
+
+    Returns
+    -------
+    dict
+        Mean RMSE of every configuration at the last rung it reached.
+
+    """
+    n_rungs = max(1, int(np.floor(np.log(len(configs)) / np.log(eta))) + 1)
+    alive = dict(enumerate(configs))
+    summary = {}
+    for rung in range(n_rungs):
+        n_epochs = max(1, int(round(max_epochs * eta ** (rung - n_rungs + 1))))
+        trials = [(config_id, dict(config, n_epochs=n_epochs), fold)
+                  for config_id, config in alive.items() for fold in range(search.n_folds)]
+        scores = search.run(trials, stage=rung)
+        for config_id, rmses in scores.items():
+            summary[config_id] = {'config': dict(alive[config_id], n_epochs=n_epochs),
+                                  'rmse': float(np.mean(rmses)), 'complete': rung == n_rungs - 1}
+        keep = max(1, len(alive) // eta)
+        ranked = sorted(alive, key=lambda config_id: summary[config_id]['rmse'])
+        alive = {config_id: alive[config_id] for config_id in ranked[:keep]}
+    return summary
+
+
+def tune(ratings, method='halving', n_configs=27, n_folds=5, n_jobs=None, prune_margin=0.01,
+         max_epochs=40, eta=3, results=results_path, seed=42):
+    """Search SVD hyperparameters by cross-validation.
+
+    Parameters
+    ----------
+    ratings : Pandas DataFrame
+        Ratings with userId, movieId and rating columns.
+    method : str
+        'grid', 'random' or 'halving'.
+    n_configs : int
+        Configurations sampled by random search and successive halving.
+    n_folds : int
+        Cross-validation folds.
+    n_jobs : int, optional
+        Worker processes. All cores are used by default.
+    prune_margin : float
+        RMSE behind the best configuration at which grid and random
+        search stop evaluating a configuration.
+    max_epochs : int
+        Epochs of the last successive halving rung.
+    eta : int
+        Reduction factor of successive halving.
+    results : str
+        JSON lines file every trial is appended to.
+    seed : int
+        Seed of the fold split and the sampled configurations.
+
+    Returns
+    -------
+    tuple (dict, list (dict))
+        The best configuration which was evaluated on every fold, and the
+        summary of every configuration, best first.
+
+    """
+    if method == 'grid':
+        configs = grid_configs()
+    elif method == 'random':
+        configs = random_configs(n_configs, seed=seed)
+    elif method == 'halving':
+        space = {name: bounds for name, bounds in SPACE.items() if name != 'n_epochs'}
+        configs = random_configs(n_configs, space, seed=seed)
+    else:
+        raise ValueError(f"Unknown search method {method!r}.")
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    os.makedirs(os.path.dirname(results) or '.', exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='tuning-') as workdir, open(results, 'a') as log:
+        split_folds(ratings, workdir, n_folds, seed)
+        pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+        try:
+            search = _Search(workdir, n_folds, pool, log, method)
+            if method == 'halving':
+                summary = successive_halving(search, configs, max_epochs, eta)
+            else:
+                summary = fold_pruned_search(search, configs, prune_margin)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    ranked = sorted(summary.values(), key=lambda row: (not row['complete'], row['rmse']))
+    return ranked[0]['config'], ranked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tune the SVD hyperparameters of the collaborative model.")
+    parser.add_argument('--ratings', default='resources/data/ratings.csv')
+    parser.add_argument('--method', choices=['grid', 'random', 'halving'], default='halving')
+    parser.add_argument('--configs', type=int, default=27)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--prune-margin', type=float, default=0.01)
+    parser.add_argument('--max-epochs', type=int, default=40)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--results', default=results_path)
+    args = parser.parse_args()
+
+    ratings = pd.read_csv(args.ratings, usecols=['userId', 'movieId', 'rating'])
+    best, ranked = tune(ratings, args.method, args.configs, args.folds, args.jobs,
+                        args.prune_margin, args.max_epochs, args.eta, args.results)
+    for row in ranked[:10]:
+        status = '' if row['complete'] else ' (stopped early)'
+        print(f"RMSE {row['rmse']:.4f}{status}: {row['config']}")
+    print(f"Best configuration: {best}. Trials logged to: {args.results}")
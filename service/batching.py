@@ -0,0 +1,140 @@
+"""
+
+    Micro-batching of concurrent recommendation requests.
+
+    Description: A `MicroBatcher` queues requests for one recommender and
+    has a single worker thread drain the queue in short batches: it waits
+    up to `max_wait` seconds after the first request for others to arrive,
+    then scores up to `max_batch_size` of them in one vectorised call.
+
+    - The queue is bounded. When it is full, `submit` raises `Overloaded`
+      straight away instead of letting latency grow without limit.
+    - Every request carries a deadline. Requests whose deadline passes
+      while queued are failed with `DeadlineExceeded` without being
+      scored.
+
+"""
+# Script dependencies
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from utils.tracing import trace
+
+
+class Overloaded(Exception):
+    """The request queue is full."""
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before it could be scored."""
+
+
+class MicroBatcher:
+    """Collects requests into batches for a batch recommender.
+
+    Parameters
+    ----------
+    recommend_batch : callable
+        Takes a list of favourite lists and `top_n`, and returns one
+        result per list, e.g. `content_model_batch`.
+    max_batch_size : int
+        Requests scored together at most.
+    max_wait : float
+        Seconds to wait for more requests after the first of a batch.
+    max_queue : int
+        Requests waiting at most before new ones are rejected.
+
+    """
+
+    def __init__(self, recommend_batch, max_batch_size=32, max_wait=0.005, max_queue=256):
+        self.recommend_batch = recommend_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self.batches = self.requests = self.rejected = self.expired = 0
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, movie_list, top_n=10, deadline=None):
+        """Queue a request.
+
+        Parameters
+        ----------
+        movie_list : list (str)
+            Favourite movies.
+        top_n : int
+            Number of recommendations.
+        deadline : float, optional
+            `time.monotonic()` value after which the result is useless.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the recommended titles.
+
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((movie_list, top_n, deadline, future))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"More than {self._queue.maxsize} requests are waiting.")
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        closes = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = closes - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=max(remaining, 0)) if remaining > 0
+                             else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            now = time.monotonic()
+            live = []
+            for request in batch:
+                deadline, future = request[2], request[3]
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if deadline is not None and now > deadline:
+                    future.set_exception(DeadlineExceeded("Expired while queued."))
+                    with self._lock:
+                        self.expired += 1
+                else:
+                    live.append(request)
+            if not live:
+                continue
+            # Rankings are prefixes of longer ones, ties included (see
+            # `similarity.top_k`), so one call serves every top_n
+            top_n = max(request[1] for request in live)
+            try:
+                with trace(getattr(self.recommend_batch, '__name__', 'batch'),
+                           batch_size=len(live), top_n=top_n):
+                    results = self.recommend_batch([request[0] for request in live], top_n)
+            except Exception as error:
+                for request in live:
+                    request[3].set_exception(error)
+            else:
+                for request, result in zip(live, results):
+                    request[3].set_result(None if result is None else result[:request[1]])
+            with self._lock:
+                self.batches += 1
+                self.requests += len(live)
+
+    def stats(self):
+        """Counters of the batcher."""
+        with self._lock:
+            return {'queued': self._queue.qsize(), 'batches': self.batches,
+                    'requests': self.requests, 'rejected': self.rejected,
+                    'expired': self.expired,
+                    'mean_batch_size': self.requests / self.batches if self.batches else 0.0}
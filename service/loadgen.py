@@ -0,0 +1,121 @@
+"""
+
+    Load generator for the recommendation service.
+
+    Description: Sends recommendation requests from an increasing number
+    of concurrent clients and reports, for each level of concurrency, the
+    throughput and the p50/p95/p99 latency of successful requests, along
+    with the count of every error status. Favourites are drawn from the
+    same title ranges the Streamlit app offers, so popular sets repeat as
+    they would in practice.
+
+    Start the server with `python -m service.server`, then run
+    `python -m service.loadgen --algorithm content` from the repository
+    root.
+
+"""
+# Script dependencies
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlparse
+from collections import Counter
+
+import numpy as np
+
+from utils.data_loader import data_path, load_movie_titles
+
+# Title ranges of the three selectboxes in `edsa_recommender.py`
+APP_RANGES = [(14930, 15200), (25055, 25255), (21100, 21200)]
+
+
+def favourite_sets(n, seed=42):
+    """`n` favourite lists picked like the app's users pick them."""
+    titles = load_movie_titles(data_path('movies.csv'))
+    ranges = [titles[start:stop] for start, stop in APP_RANGES if titles[start:stop]]
+    if not ranges:
+        ranges = [titles]
+    rng = random.Random(seed)
+    return [[rng.choice(options) for options in ranges] for _ in range(n)]
+
+
+def _client(url, algorithm, requests, top_n, timeout_ms, latencies, statuses, lock):
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+    for movies in requests:
+        body = json.dumps({'algorithm': algorithm, 'movies': movies, 'top_n': top_n,
+                           'timeout_ms': timeout_ms}).encode()
+        start = time.perf_counter()
+        try:
+            connection.request('POST', '/recommend', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            status = 'connection error'
+        elapsed = time.perf_counter() - start
+        with lock:
+            statuses[status] += 1
+            if status == 200:
+                latencies.append(elapsed)
+    connection.close()
+
+
+def run_level(url, algorithm, concurrency, n_requests, top_n=10, timeout_ms=2000, seed=42):
+    """Send `n_requests` from `concurrency` clients and summarise them.
+
+    Returns
+    -------
+    dict
+        Throughput in requests per second, latency percentiles in
+        milliseconds and the number of responses with each status.
+
+    """
+    requests = favourite_sets(n_requests, seed)
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+    threads = [threading.Thread(target=_client,
+                                args=(url, algorithm, requests[i::concurrency], top_n, timeout_ms,
+                                      latencies, statuses, lock))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    percentiles = np.percentile(np.array(latencies) * 1000, [50, 95, 99]) if latencies else [np.nan] * 3
+    return {'concurrency': concurrency, 'requests': n_requests, 'seconds': elapsed,
+            'throughput': statuses[200] / elapsed, 'p50_ms': float(percentiles[0]),
+            'p95_ms': float(percentiles[1]), 'p99_ms': float(percentiles[2]),
+            'statuses': {str(status): count for status, count in statuses.items()}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the recommendation service under load.")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--algorithm', choices=['content', 'collab'], default='content')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32',
+                        help="Comma separated numbers of concurrent clients.")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per level.")
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--timeout-ms', type=float, default=2000.0)
+    parser.add_argument('--output', help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = []
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        row = run_level(args.url, args.algorithm, concurrency, args.requests, args.top_n,
+                        args.timeout_ms)
+        results.append(row)
+        errors = {status: count for status, count in row['statuses'].items() if status != '200'}
+        print(f"{concurrency:>4} clients: {row['throughput']:8.1f} req/s, "
+              f"p50 {row['p50_ms']:7.1f} ms, p95 {row['p95_ms']:7.1f} ms, "
+              f"p99 {row['p99_ms']:7.1f} ms" + (f", errors {errors}" if errors else ''))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
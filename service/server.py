@@ -0,0 +1,178 @@
+"""
+
+    Local JSON API around the content and collaborative recommenders.
+
+    Description: Loads the models once and serves them over HTTP, so other
+    services can get recommendations without importing the Streamlit app.
+    Concurrent requests for the same algorithm are scored together in
+    micro-batches, see `service/batching.py`.
+
+        POST /recommend  {"algorithm": "content" | "collab",
+                          "movies": ["Toy Story (1995)", ...],
+                          "top_n": 10, "timeout_ms": 2000}
+        GET  /health
+        GET  /stats
+
+    Responses are JSON. A full queue answers 503 with a Retry-After
+    header, a request which misses its deadline answers 504, and one
+    whose batch failed in the recommender answers 500.
+
+    Run `python -m service.server --port 8000` from the repository root.
+
+"""
+# Script dependencies
+import json
+import time
+import argparse
+from concurrent.futures import TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .batching import MicroBatcher, Overloaded, DeadlineExceeded
+
+# Upper bounds on what a client may ask for
+MAX_TOP_N = 100
+MAX_MOVIES = 50
+
+
+class RecommendationService:
+    """The recommenders, each behind its own micro-batcher.
+
+    Parameters
+    ----------
+    max_batch_size, max_wait, max_queue
+        Passed to every `MicroBatcher`.
+    default_timeout : float
+        Seconds a request may take when it does not set `timeout_ms`.
+
+    """
+
+    def __init__(self, max_batch_size=32, max_wait=0.005, max_queue=256, default_timeout=2.0):
+        from recommenders.content_based import content_model_batch, load_content_index
+        from recommenders.collaborative_based import collab_model_batch, load_item_neighbours
+        from utils.ratings_store import load_ratings_store
+
+        # Loading every model up front keeps the first requests fast
+        load_content_index()
+        load_ratings_store()
+        load_item_neighbours()
+        self.batchers = {
+            'content': MicroBatcher(content_model_batch, max_batch_size, max_wait, max_queue),
+            'collab': MicroBatcher(collab_model_batch, max_batch_size, max_wait, max_queue),
+        }
+        self.default_timeout = default_timeout
+        self.started = time.time()
+
+    def recommend(self, request):
+        """Answer one decoded request body with an HTTP status and payload."""
+        algorithm = request.get('algorithm')
+        movies = request.get('movies')
+        top_n = request.get('top_n', 10)
+        timeout_ms = request.get('timeout_ms', self.default_timeout * 1000)
+        if algorithm not in self.batchers:
+            return 400, {'error': f"algorithm must be one of {sorted(self.batchers)}."}
+        if (not isinstance(movies, list) or not movies or len(movies) > MAX_MOVIES
+                or not all(isinstance(title, str) for title in movies)):
+            return 400, {'error': f"movies must be a list of 1 to {MAX_MOVIES} titles."}
+        if isinstance(top_n, bool) or not isinstance(top_n, int) or not 0 < top_n <= MAX_TOP_N:
+            return 400, {'error': f"top_n must be an integer from 1 to {MAX_TOP_N}."}
+        if (isinstance(timeout_ms, bool) or not isinstance(timeout_ms, (int, float))
+                or timeout_ms <= 0):
+            return 400, {'error': "timeout_ms must be a positive number."}
+        timeout = timeout_ms / 1000
+
+        start = time.monotonic()
+        try:
+            future = self.batchers[algorithm].submit(movies, top_n, deadline=start + timeout)
+            titles = future.result(timeout=timeout)
+        except Overloaded as error:
+            return 503, {'error': str(error)}
+        except (DeadlineExceeded, TimeoutError):
+            return 504, {'error': f"No result within {timeout * 1000:.0f} ms."}
+        except Exception as error:
+            return 500, {'error': f"The recommender failed: {type(error).__name__}: {error}"}
+        if titles is None:
+            return 422, {'error': "None of the movies are known to the recommender."}
+        return 200, {'algorithm': algorithm, 'recommendations': titles,
+                     'latency_ms': (time.monotonic() - start) * 1000}
+
+    def stats(self):
+        return {'uptime_s': time.time() - self.started,
+                **{algorithm: batcher.stats() for algorithm, batcher in self.batchers.items()}}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Routes HTTP requests to the `service` of the server."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+
+    def _send(self, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send(200, self.server.service.stats())
+        else:
+            self._send(404, {'error': f"No route for GET {self.path}."})
+
+    def do_POST(self):
+        if self.path != '/recommend':
+            self._send(404, {'error': f"No route for POST {self.path}."})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError
+        except ValueError:
+            self._send(400, {'error': "The body must be a JSON object."})
+            return
+        status, payload = self.server.service.recommend(request)
+        self._send(status, payload, [('Retry-After', '1')] if status == 503 else ())
+
+    def log_message(self, format, *args):
+        # Per-request logging would dominate the cost of a request
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 refuses connections under a burst of clients
+    request_queue_size = 128
+
+
+def make_server(host='127.0.0.1', port=8000, **options):
+    """An HTTP server with a loaded `RecommendationService`, not yet started."""
+    server = _Server((host, port), RequestHandler)
+    server.service = RecommendationService(**options)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve recommendations over a local JSON API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--max-queue', type=int, default=256)
+    parser.add_argument('--timeout-ms', type=float, default=2000.0)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, max_batch_size=args.max_batch_size,
+                         max_wait=args.max_wait_ms / 1000, max_queue=args.max_queue,
+                         default_timeout=args.timeout_ms / 1000)
+    print(f"Serving recommendations on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
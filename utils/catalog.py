@@ -0,0 +1,119 @@
+"""
+
+    Constant-time lookups between movie titles, IDs and matrix rows.
+
+    Author: Explore Data Science Academy.
+
+"""
+# Data handling dependencies
+import os
+import functools
+import numpy as np
+
+
+class Catalog:
+    """Bidirectional mapping between titles, movie IDs and matrix rows.
+
+    Row `i` of a catalog describes row `i` of whichever matrix it was
+    built for. Titles are not unique within MovieLens, so a title always
+    resolves to the row of its lowest movie ID.
+
+    Parameters
+    ----------
+    movie_ids : array-like (int)
+        MovieLens Movie ID of each row.
+    titles : array-like (str)
+        Title of each row.
+
+    """
+
+    def __init__(self, movie_ids, titles):
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.titles = np.asarray(titles, dtype=object)
+        self._row_by_id = {movie_id: row for row, movie_id in enumerate(self.movie_ids.tolist())}
+        self._row_by_title = {}
+        for row in np.argsort(self.movie_ids, kind='stable').tolist():
+            self._row_by_title.setdefault(self.titles[row], row)
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def __contains__(self, title):
+        return title in self._row_by_title
+
+    @classmethod
+    def from_frame(cls, movies):
+        """Build a catalog from a frame with `movieId` and `title` columns."""
+        return cls(movies['movieId'].to_numpy(), movies['title'].to_numpy())
+
+    def row_of_title(self, title):
+        """Row of `title`, or None if it is not in the catalog."""
+        return self._row_by_title.get(title)
+
+    def row_of_id(self, movie_id):
+        """Row of `movie_id`, or None if it is not in the catalog."""
+        return self._row_by_id.get(movie_id)
+
+    def id_of_title(self, title):
+        """Movie ID of `title`, or None if it is not in the catalog."""
+        row = self._row_by_title.get(title)
+        return None if row is None else int(self.movie_ids[row])
+
+    def title_of_id(self, movie_id):
+        """Title of `movie_id`, or None if it is not in the catalog."""
+        row = self._row_by_id.get(movie_id)
+        return None if row is None else self.titles[row]
+
+    def rows_of_titles(self, titles):
+        """Rows of the known titles in `titles`, in the given order."""
+        rows = (self._row_by_title.get(title) for title in titles)
+        return [row for row in rows if row is not None]
+
+    def subset(self, movie_ids):
+        """Catalog whose rows follow `movie_ids`.
+
+        Parameters
+        ----------
+        movie_ids : array-like (int)
+            Row order of the matrix the new catalog describes. Every ID
+            must be present in this catalog.
+
+        Returns
+        -------
+        Catalog
+            Catalog with one row per entry of `movie_ids`.
+
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        rows = [self._row_by_id[movie_id] for movie_id in movie_ids.tolist()]
+        return Catalog(movie_ids, self.titles[rows])
+
+
+def load_catalog(path_to_movies):
+    """Load the process-wide catalog of a movie database.
+
+    The catalog is re-read when the file's size or modification time
+    changes, so titles appended to the database are picked up.
+
+    Parameters
+    ----------
+    path_to_movies : str
+        Relative or absolute path to movie database stored
+        in .csv format.
+
+    Returns
+    -------
+    Catalog
+        Catalog with one row per movie record, in file order.
+
+    """
+    stat = os.stat(path_to_movies)
+    return _read_catalog(path_to_movies, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_catalog(path_to_movies, size, mtime):
+    from .data_loader import load_dataset
+    df = load_dataset(path_to_movies)
+    df = df.dropna()
+    return Catalog.from_frame(df)
@@ -6,9 +6,147 @@
 
 """
 # Data handling dependencies
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+import hashlib
+import functools
 import pandas as pd
 import numpy as np
 
+from .catalog import load_catalog
+from .tracing import span
+
+# Directory holding movies.csv, ratings.csv and imdb_data.csv.
+data_dir = os.environ.get('RECOMMENDER_DATA_DIR', 'resources/data')
+
+# Derived tables are cached next to the data, keyed by a hash of the files
+# they come from, so processes using other data directories keep their own.
+cache_dir = os.path.join(data_dir, 'cache')
+
+# Uncompressed Feather (Arrow IPC) keeps the cache columnar and can be
+# memory mapped; pickle is the fallback without pyarrow.
+try:
+    from pyarrow import feather
+    _cache_format = 'feather'
+except ImportError:
+    _cache_format = 'pkl'
+
+# String columns with fewer distinct values than this share of their rows
+# are stored as categoricals.
+category_ratio = 0.5
+
+# Smallest types holding the columns of ratings.csv, applied while parsing.
+RATINGS_DTYPES = {'userId': np.int32, 'movieId': np.int32, 'rating': np.float32,
+                  'timestamp': np.int64}
+
+# Rows of ratings.csv parsed at once by `iter_ratings`.
+ratings_chunk_rows = 500000
+
+_fingerprints = {}
+
+
+def _shared_resource(func):
+    """Cache a loader once per process, shared by every Streamlit session.
+
+    Streamlit's resource cache is used when it is available, so that the
+    app's scripts and sessions all hold the same object. Offline scripts
+    without Streamlit fall back to an in-process LRU cache.
+    """
+    try:
+        import streamlit as st
+    except ImportError:
+        return functools.lru_cache(maxsize=8)(func)
+    if hasattr(st, 'cache_resource'):
+        return st.cache_resource(max_entries=8, show_spinner=False)(func)
+    if hasattr(st, 'experimental_singleton'):
+        return st.experimental_singleton(show_spinner=False)(func)
+    return functools.lru_cache(maxsize=8)(func)
+
+
+def compact_dtypes(df):
+    """Downcast a freshly parsed table to compact column types.
+
+    Integer columns become int32 and float columns float32 where their
+    values allow it, and repetitive string columns become categoricals,
+    which store each distinct value once.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        Table as parsed by `pandas.read_csv`. It is modified in place.
+
+    Returns
+    -------
+    Pandas DataFrame
+        The same table.
+
+    """
+    int32 = np.iinfo(np.int32)
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_integer_dtype(values):
+            if values.empty or (values.min() >= int32.min and values.max() <= int32.max):
+                df[column] = values.astype(np.int32)
+        elif pd.api.types.is_float_dtype(values):
+            df[column] = values.astype(np.float32)
+        elif pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            if values.nunique() < category_ratio * len(values):
+                df[column] = values.astype('category')
+    return df
+
+
+@_shared_resource
+def _read_table(path, size, mtime):
+    name = os.path.splitext(os.path.basename(path))[0]
+    dtype = RATINGS_DTYPES if name == 'ratings' else None
+    return cached_frame(name, [path], lambda: compact_dtypes(pd.read_csv(path, dtype=dtype)),
+                        key=f"{size}-{mtime}")
+
+
+def data_path(filename):
+    """Path of a file in the configured data directory."""
+    return os.path.join(data_dir, filename)
+
+
+def load_dataset(filename):
+    """Load one of the CSV datasets, reading it only on first access.
+
+    Every module shares the same frame, which is re-read when the file's
+    size or modification time changes. Callers must not modify it in
+    place. The CSV is parsed once into a binary cache with compact
+    column types, see `compact_dtypes`, and later loads read the cache.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file within `data_dir`, or a path to a CSV file.
+
+    Returns
+    -------
+    Pandas DataFrame
+        Contents of the file.
+
+    """
+    path = filename if os.path.dirname(filename) else data_path(filename)
+    stat = os.stat(path)
+    return _read_table(path, stat.st_size, stat.st_mtime_ns)
+
+
+def load_movies():
+    """The shared movies table, see `load_dataset`."""
+    return load_dataset('movies.csv')
+
+
+def load_imdb():
+    """The shared IMDB metadata table, see `load_dataset`."""
+    return load_dataset('imdb_data.csv')
+
+
 def load_movie_titles(path_to_movies):
     """Load movie titles from database records.
 
@@ -24,7 +162,273 @@ def load_movie_titles(path_to_movies):
         Movie titles.
 
     """
-    df = pd.read_csv(path_to_movies)
-    df = df.dropna()
-    movie_list = df['title'].to_list()
+    movie_list = load_catalog(path_to_movies).titles.tolist()
     return movie_list
+
+
+def iter_ratings(columns=('userId', 'movieId', 'rating'), path=None, chunk_rows=None):
+    """Read the ratings a chunk at a time, parsing only the needed columns.
+
+    Columns are parsed straight into `RATINGS_DTYPES`, so a chunk takes
+    12 bytes per rating for the default columns, against 32 for the
+    default 64-bit parse of every column.
+
+    Parameters
+    ----------
+    columns : list (str)
+        Columns of ratings.csv to read.
+    path : str, optional
+        Ratings file, `ratings.csv` of the data directory by default.
+    chunk_rows : int, optional
+        Rows per chunk, `ratings_chunk_rows` by default.
+
+    Yields
+    ------
+    Pandas DataFrame
+        Consecutive rows of the file with the requested columns.
+
+    """
+    path = path or data_path('ratings.csv')
+    with pd.read_csv(path, usecols=list(columns), dtype={c: RATINGS_DTYPES[c] for c in columns},
+                     chunksize=chunk_rows or ratings_chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def _add_bincount(totals, ids, weights=None):
+    """Add the bincount of `ids` to `totals`, growing it if needed."""
+    counts = np.bincount(ids, weights=weights)
+    if len(counts) > len(totals):
+        totals = np.concatenate([totals, np.zeros(len(counts) - len(totals), dtype=totals.dtype)])
+    totals[:len(counts)] += counts.astype(totals.dtype, copy=False)
+    return totals
+
+
+def _add_value_counts(totals, values):
+    for value, count in zip(*np.unique(values, return_counts=True)):
+        totals[value.item()] = totals.get(value.item(), 0) + int(count)
+
+
+class RatingsSummary:
+    """Aggregates of the ratings, folded in one chunk at a time.
+
+    Memory depends on the largest Movie ID and the number of distinct
+    rating values and years, not on the number of ratings.
+
+    Parameters
+    ----------
+    movie_ids : array-like (int), optional
+        Only ratings of these movies are counted.
+
+    Attributes
+    ----------
+    n_ratings : int
+        Number of ratings folded in.
+
+    """
+
+    def __init__(self, movie_ids=None):
+        self.movie_ids = None if movie_ids is None else np.unique(movie_ids)
+        self.n_ratings = 0
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._sums = np.zeros(0, dtype=np.float64)
+        self._ratings = {}
+        self._years = {}
+
+    def add(self, chunk):
+        """Fold in a chunk with movieId and rating, and optionally timestamp, columns."""
+        if self.movie_ids is not None:
+            chunk = chunk[np.isin(chunk['movieId'].to_numpy(), self.movie_ids)]
+        movies = chunk['movieId'].to_numpy()
+        ratings = chunk['rating'].to_numpy()
+        self._counts = _add_bincount(self._counts, movies)
+        self._sums = _add_bincount(self._sums, movies, weights=ratings)
+        _add_value_counts(self._ratings, ratings)
+        if 'timestamp' in chunk:
+            # Calendar years (UTC) of the Unix timestamps
+            years = chunk['timestamp'].to_numpy().astype('datetime64[s]').astype('datetime64[Y]')
+            _add_value_counts(self._years, years.astype(np.int64) + 1970)
+        self.n_ratings += len(chunk)
+        return self
+
+    def movie_stats(self):
+        """Number of ratings and mean rating of every rated movie."""
+        movie_ids = np.flatnonzero(self._counts)
+        counts = self._counts[movie_ids]
+        return pd.DataFrame({'movieId': movie_ids, 'count': counts,
+                             'mean_rating': self._sums[movie_ids] / counts})
+
+    def rating_counts(self):
+        """Number of ratings given at each rating value."""
+        values = sorted(self._ratings)
+        return pd.DataFrame({'rating': np.array(values, dtype=np.float32),
+                             'count': [self._ratings[value] for value in values]})
+
+    def year_counts(self):
+        """Number of ratings made in each year (UTC)."""
+        years = sorted(self._years)
+        return pd.DataFrame({'year': years, 'count': [self._years[year] for year in years]})
+
+
+def summarise_ratings(movie_ids=None, path=None, chunk_rows=None):
+    """Aggregate the ratings in a single streaming pass.
+
+    Parameters
+    ----------
+    movie_ids : array-like (int), optional
+        Only ratings of these movies are counted.
+    path : str, optional
+        Ratings file, `ratings.csv` of the data directory by default.
+    chunk_rows : int, optional
+        Rows per chunk, see `iter_ratings`.
+
+    Returns
+    -------
+    RatingsSummary
+        Per-movie, per-rating and per-year aggregates.
+
+    """
+    summary = RatingsSummary(movie_ids)
+    with span('summarise ratings') as stage:
+        for chunk in iter_ratings(['movieId', 'rating', 'timestamp'], path, chunk_rows):
+            summary.add(chunk)
+        stage.items = summary.n_ratings
+    return summary
+
+
+def file_fingerprint(*paths):
+    """Hash the contents of one or more files.
+
+    Hashes are remembered for as long as a file's size and modification
+    time stay the same, so repeated calls do not re-read unchanged files.
+
+    Parameters
+    ----------
+    paths : str
+        Files to hash, in order.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the current contents of all `paths`.
+
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in _fingerprints:
+            file_digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    file_digest.update(block)
+            _fingerprints[key] = file_digest.hexdigest()
+        digest.update(_fingerprints[key].encode())
+    return digest.hexdigest()
+
+
+def cached_frame(name, source_paths, build, key=None):
+    """Load a derived table from the on-disk cache, building it if stale.
+
+    Parameters
+    ----------
+    name : str
+        Name of the cached table.
+    source_paths : list (str)
+        Files the table is derived from. Changing any of them invalidates
+        the cache.
+    build : callable
+        Function returning the table as a Pandas DataFrame.
+    key : str, optional
+        Version of the sources. Defaults to a hash of their contents.
+
+    Returns
+    -------
+    Pandas DataFrame
+        The cached or freshly built table.
+
+    """
+    key = key or file_fingerprint(*source_paths)
+    path = os.path.join(cache_dir, f"{name}-{key}.{_cache_format}")
+    if os.path.exists(path):
+        with span(f"read {name}") as stage:
+            if _cache_format == 'feather':
+                df = feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
+            else:
+                df = pd.read_pickle(path)
+            stage.items = len(df)
+        return df
+
+    with span(f"build {name}") as stage:
+        df = build()
+        stage.items = len(df)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Remove tables built from earlier versions of the data
+    for stale_path in glob.glob(os.path.join(cache_dir, f"{name}-*")):
+        os.remove(stale_path)
+    temp_path = path + '.tmp'
+    if _cache_format == 'feather':
+        df.reset_index(drop=True).to_feather(temp_path, compression='uncompressed')
+    else:
+        df.to_pickle(temp_path)
+    os.replace(temp_path, path)
+    return df
+
+
+def _measure(filename, source):
+    """Time one load of a dataset in this process, for `load_report`."""
+    import resource
+
+    path = data_path(filename)
+    # ru_maxrss is in kilobytes on Linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    if source == 'csv':
+        df = pd.read_csv(path)
+    else:
+        df = load_dataset(filename)
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'dataset': filename, 'source': source, 'seconds': seconds,
+            'rss_growth_mb': peak_rss - rss_before, 'peak_rss_mb': peak_rss,
+            'frame_mb': df.memory_usage(deep=True).sum() / 2 ** 20}
+
+
+def load_report(filenames=('movies.csv', 'ratings.csv', 'imdb_data.csv')):
+    """Compare parsing each CSV with loading it from the binary cache.
+
+    Every load runs in a fresh interpreter, so the timings are cold starts
+    and the peak resident memory belongs to that load alone.
+
+    Returns
+    -------
+    list (dict)
+        Load time, growth and peak of the resident memory, and in-memory
+        size of every dataset, from the CSV and from the cache.
+
+    """
+    for filename in filenames:
+        # Make sure the cache exists before timing it
+        load_dataset(filename)
+    report = []
+    for filename in filenames:
+        for source in ['csv', 'cache']:
+            output = subprocess.run([sys.executable, '-m', 'utils.data_loader', '--measure',
+                                     filename, source], capture_output=True, text=True, check=True,
+                                    env=dict(os.environ, RECOMMENDER_DATA_DIR=data_dir))
+            report.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report load time and memory of the datasets.")
+    parser.add_argument('--measure', nargs=2, metavar=('FILENAME', 'SOURCE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(_measure(*args.measure)))
+    else:
+        for row in load_report():
+            print(f"{row['dataset']:>14} from {row['source']:>5}: {row['seconds']:.2f}s, "
+                  f"RSS +{row['rss_growth_mb']:.0f} MB (peak {row['peak_rss_mb']:.0f} MB), "
+                  f"frame {row['frame_mb']:.0f} MB")
@@ -0,0 +1,110 @@
+"""
+
+    Summary tables behind the Movie Data Analysis page.
+
+    Author: Explore Data Science Academy.
+
+    Description: Each table is aggregated from the ratings and movies with
+    vectorised group-bys the first time its chart is opened, saved to the
+    data cache so that later process starts reuse it, and shared by every
+    session. Editing a source file rebuilds the tables derived from it.
+
+    The ratings are never loaded whole: a single streaming pass folds them
+    into per-movie, per-rating and per-year counts, see
+    `utils.data_loader.summarise_ratings`, which every table starts from.
+
+"""
+# Data handling dependencies
+import os
+import pandas as pd
+import numpy as np
+
+from .data_loader import _shared_resource, cached_frame, data_path, load_movies, summarise_ratings
+
+
+def _sources_key(filenames):
+    """Version of the source files, from their size and mtime."""
+    stats = [os.stat(data_path(filename)) for filename in filenames]
+    return '-'.join(f"{stat.st_size}-{stat.st_mtime_ns}" for stat in stats)
+
+
+def _aggregate(name, filenames, build):
+    """Load a summary table, keyed on the size and mtime of its sources."""
+    paths = [data_path(filename) for filename in filenames]
+    return _load_aggregate(name, tuple(paths), _sources_key(filenames), build)
+
+
+@_shared_resource
+def _load_aggregate(name, paths, key, _build):
+    return cached_frame(f"eda_{name}", list(paths), _build, key=key)
+
+
+@_shared_resource
+def _load_summary(key):
+    return summarise_ratings(movie_ids=load_movies()['movieId'].to_numpy())
+
+
+def _titled_summary():
+    """Aggregates of the ratings of the movies listed in movies.csv."""
+    return _load_summary(_sources_key(['ratings.csv', 'movies.csv']))
+
+
+def _build_rating_histogram():
+    return _titled_summary().rating_counts()
+
+
+def _build_title_ratings():
+    per_movie = _titled_summary().movie_stats().set_index('movieId')
+    per_movie['sum'] = per_movie['mean_rating'] * per_movie['count']
+    titles = load_movies().set_index('movieId')['title']
+    # Movies sharing a title are counted together
+    per_title = per_movie.groupby(titles.reindex(per_movie.index).to_numpy())[['sum', 'count']].sum()
+    return pd.DataFrame({'title': per_title.index.to_numpy(),
+                         'mean_rating': (per_title['sum'] / per_title['count']).to_numpy(),
+                         'num_ratings': per_title['count'].to_numpy()})
+
+
+def _build_ratings_per_year():
+    return _titled_summary().year_counts()
+
+
+def _build_genre_counts():
+    ratings_per_movie = _titled_summary().movie_stats().set_index('movieId')['count']
+    movies = load_movies()
+    genres = pd.DataFrame({'movieId': movies['movieId'],
+                           'genre': movies['genres'].astype(str).str.split('|')}).explode('genre')
+    genres['count'] = genres['movieId'].map(ratings_per_movie).fillna(0).astype(np.int64)
+    counts = genres.groupby('genre')['count'].sum()
+    counts = counts[counts > 0].sort_values(ascending=False)
+    return pd.DataFrame({'genre': counts.index.to_numpy(), 'count': counts.to_numpy()})
+
+
+def _build_release_year_counts():
+    years = load_movies()['title'].astype(str).str.extract(r'\((\d{4})\)\s*$', expand=False)
+    counts = years.dropna().astype(int).value_counts().sort_index()
+    return pd.DataFrame({'year': counts.index.to_numpy(), 'count': counts.to_numpy()})
+
+
+def rating_histogram():
+    """Number of ratings given at each rating value."""
+    return _aggregate('rating_histogram', ['ratings.csv', 'movies.csv'], _build_rating_histogram)
+
+
+def title_ratings():
+    """Mean rating and number of ratings of every rated title."""
+    return _aggregate('title_ratings', ['ratings.csv', 'movies.csv'], _build_title_ratings)
+
+
+def ratings_per_year():
+    """Number of ratings made in each year (UTC)."""
+    return _aggregate('ratings_per_year', ['ratings.csv', 'movies.csv'], _build_ratings_per_year)
+
+
+def genre_counts():
+    """Number of ratings of the movies in each genre, most rated first."""
+    return _aggregate('genre_counts', ['ratings.csv', 'movies.csv'], _build_genre_counts)
+
+
+def release_year_counts():
+    """Number of movies released in each year, parsed from their titles."""
+    return _aggregate('release_year_counts', ['movies.csv'], _build_release_year_counts)
@@ -0,0 +1,286 @@
+"""
+
+    Compressed per-user and per-item index of the MovieLens ratings.
+
+    Author: Explore Data Science Academy.
+
+"""
+# Data handling dependencies
+import os
+import json
+import threading
+import numpy as np
+from scipy import sparse
+
+from .data_loader import _add_bincount, data_path, file_fingerprint, iter_ratings
+from .tracing import span
+
+# The store is persisted here and loaded on first use.
+ratings_store_path = 'resources/models/ratings_store'
+_ratings_store = None
+_ratings_store_lock = threading.Lock()
+
+_ARRAYS = ['user_ids', 'item_ids', 'user_indptr', 'user_items', 'user_ratings',
+           'item_indptr', 'item_users', 'item_ratings']
+
+
+class RatingsStore:
+    """Ratings held as CSR (by user) and CSC (by item) arrays.
+
+    Rows are numbered by position in `user_ids` and `item_ids`, which are
+    sorted. A user rating the same movie more than once keeps the highest
+    rating. Slicing the ratings of one user or item returns views of the
+    arrays, so a store loaded with memory mapping is never copied.
+
+    Parameters
+    ----------
+    user_ids, item_ids : numpy.ndarray
+        MovieLens User and Movie IDs of the rows and columns.
+    user_indptr, user_items, user_ratings : numpy.ndarray
+        CSR arrays of the user-by-item ratings matrix.
+    item_indptr, item_users, item_ratings : numpy.ndarray
+        CSC arrays of the same matrix.
+
+    """
+
+    def __init__(self, user_ids, item_ids, user_indptr, user_items, user_ratings,
+                 item_indptr, item_users, item_ratings):
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        self.user_indptr = user_indptr
+        self.user_items = user_items
+        self.user_ratings = user_ratings
+        self.item_indptr = item_indptr
+        self.item_users = item_users
+        self.item_ratings = item_ratings
+        self._user_rows = {user_id: row for row, user_id in enumerate(user_ids.tolist())}
+        self._item_rows = {item_id: row for row, item_id in enumerate(item_ids.tolist())}
+
+    @classmethod
+    def from_frame(cls, ratings):
+        """Build the store from a frame with userId, movieId and rating columns."""
+        users = ratings['userId'].to_numpy()
+        items = ratings['movieId'].to_numpy()
+        user_ids, user_rows = np.unique(users, return_inverse=True)
+        item_ids, item_rows = np.unique(items, return_inverse=True)
+        return cls.from_rows(user_ids, item_ids, user_rows, item_rows,
+                             ratings['rating'].to_numpy())
+
+    @classmethod
+    def from_csv(cls, path=None, chunk_rows=None):
+        """Build the store from a ratings file without loading it whole.
+
+        The file is streamed twice. The first pass counts the ratings of
+        every user and movie, which sizes the CSR arrays exactly, and the
+        second scatters every chunk straight into them. Besides the store
+        itself, memory is bounded by the chunk size and the largest IDs.
+
+        Parameters
+        ----------
+        path : str, optional
+            Ratings file, `ratings.csv` of the data directory by default.
+        chunk_rows : int, optional
+            Rows per chunk, see `utils.data_loader.iter_ratings`.
+
+        Returns
+        -------
+        RatingsStore
+            The same store `from_frame` builds from the whole file.
+
+        """
+        user_counts = item_counts = np.zeros(0, dtype=np.int64)
+        for chunk in iter_ratings(['userId', 'movieId'], path, chunk_rows):
+            user_counts = _add_bincount(user_counts, chunk['userId'].to_numpy())
+            item_counts = _add_bincount(item_counts, chunk['movieId'].to_numpy())
+        user_ids, item_ids = np.flatnonzero(user_counts), np.flatnonzero(item_counts)
+        # Rows of the IDs, looked up by indexing
+        user_rows_of = np.zeros(len(user_counts), dtype=np.int64)
+        user_rows_of[user_ids] = np.arange(len(user_ids))
+        item_rows_of = np.zeros(len(item_counts), dtype=np.int32)
+        item_rows_of[item_ids] = np.arange(len(item_ids))
+
+        indptr = np.concatenate([[0], np.cumsum(user_counts[user_ids])]).astype(np.int64)
+        items = np.empty(indptr[-1], dtype=np.int32)
+        values = np.empty(indptr[-1], dtype=np.float32)
+        filled = np.zeros(len(user_ids), dtype=np.int64)
+        for chunk in iter_ratings(['userId', 'movieId', 'rating'], path, chunk_rows):
+            rows = user_rows_of[chunk['userId'].to_numpy()]
+            order = np.argsort(rows, kind='stable')
+            rows = rows[order]
+            # Each rating goes after those of its user from earlier chunks
+            positions = (indptr[rows] + filled[rows]
+                         + np.arange(len(rows)) - np.searchsorted(rows, rows))
+            items[positions] = item_rows_of[chunk['movieId'].to_numpy()[order]]
+            values[positions] = chunk['rating'].to_numpy()[order]
+            filled += np.bincount(rows, minlength=len(user_ids))
+
+        matrix = sparse.csr_matrix((values, items, indptr), shape=(len(user_ids), len(item_ids)))
+        matrix.sort_indices()
+        starts = np.zeros(len(items), dtype=bool)
+        starts[indptr[:-1]] = True
+        if np.any((matrix.indices[1:] == matrix.indices[:-1]) & ~starts[1:]):
+            # Duplicate ratings are rare, the general path keeps the highest
+            coo = matrix.tocoo()
+            return cls.from_rows(user_ids, item_ids, coo.row, coo.col, coo.data)
+        transposed = matrix.tocsc()
+        return cls(user_ids.astype(np.int64), item_ids.astype(np.int64),
+                   matrix.indptr.astype(np.int64), matrix.indices.astype(np.int32, copy=False),
+                   matrix.data, transposed.indptr.astype(np.int64),
+                   transposed.indices.astype(np.int32, copy=False), transposed.data)
+
+    @classmethod
+    def from_rows(cls, user_ids, item_ids, user_rows, item_rows, values):
+        """Build the store from (user row, item row, rating) triplets."""
+        # Keeping the highest of any duplicate ratings
+        order = np.lexsort((values, item_rows, user_rows))
+        user_rows, item_rows, values = user_rows[order], item_rows[order], values[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (user_rows[1:] != user_rows[:-1]) | (item_rows[1:] != item_rows[:-1])
+        user_rows, item_rows, values = user_rows[last], item_rows[last], values[last]
+
+        shape = (len(user_ids), len(item_ids))
+        matrix = sparse.csr_matrix(
+            (values.astype(np.float32), item_rows.astype(np.int32), _indptr(user_rows, shape[0])),
+            shape=shape)
+        transposed = matrix.tocsc()
+        return cls(np.asarray(user_ids, dtype=np.int64), np.asarray(item_ids, dtype=np.int64),
+                   matrix.indptr.astype(np.int64), matrix.indices.astype(np.int32),
+                   matrix.data, transposed.indptr.astype(np.int64),
+                   transposed.indices.astype(np.int32), transposed.data)
+
+    @property
+    def n_users(self):
+        return len(self.user_ids)
+
+    @property
+    def n_items(self):
+        return len(self.item_ids)
+
+    @property
+    def n_ratings(self):
+        return len(self.user_ratings)
+
+    def user_row(self, user_id):
+        """Row of `user_id`, or None if the user has no ratings."""
+        return self._user_rows.get(user_id)
+
+    def item_row(self, item_id):
+        """Column of `item_id`, or None if the movie has no ratings."""
+        return self._item_rows.get(item_id)
+
+    def ratings_of_user(self, user_row):
+        """Item columns and ratings of one user, as views."""
+        start, stop = self.user_indptr[user_row], self.user_indptr[user_row + 1]
+        return self.user_items[start:stop], self.user_ratings[start:stop]
+
+    def ratings_of_item(self, item_row):
+        """User rows and ratings of one item, as views."""
+        start, stop = self.item_indptr[item_row], self.item_indptr[item_row + 1]
+        return self.item_users[start:stop], self.item_ratings[start:stop]
+
+    def user_matrix(self):
+        """The user-by-item ratings as a CSR matrix sharing the store's arrays."""
+        return sparse.csr_matrix((self.user_ratings, self.user_items, self.user_indptr),
+                                 shape=(self.n_users, self.n_items), copy=False)
+
+    def item_matrix(self):
+        """The item-by-user ratings as a CSR matrix sharing the store's arrays."""
+        return sparse.csr_matrix((self.item_ratings, self.item_users, self.item_indptr),
+                                 shape=(self.n_items, self.n_users), copy=False)
+
+    def user_submatrix(self, user_rows):
+        """Ratings of the given users only.
+
+        Parameters
+        ----------
+        user_rows : list (int)
+            Rows of the users to keep.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            One row per entry of `user_rows`, one column per item.
+
+        """
+        user_rows = np.asarray(user_rows, dtype=np.int64)
+        starts, stops = self.user_indptr[user_rows], self.user_indptr[user_rows + 1]
+        lengths = stops - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return sparse.csr_matrix(
+            (self.user_ratings[positions], self.user_items[positions], indptr),
+            shape=(len(user_rows), self.n_items))
+
+    def save(self, path, source_fingerprint=None):
+        """Write the store to the directory `path` as .npy arrays.
+
+        Every file is written aside and renamed into place, so processes
+        still mapping an older store keep reading its unchanged files.
+
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            file_path = os.path.join(path, f"{name}.npy")
+            with open(file_path + '.tmp', 'wb') as file:
+                np.save(file, getattr(self, name))
+            os.replace(file_path + '.tmp', file_path)
+        manifest_path = os.path.join(path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump({'source': source_fingerprint, 'n_users': self.n_users,
+                       'n_items': self.n_items, 'n_ratings': self.n_ratings}, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Read a store written with `save`, memory mapping its arrays."""
+        return cls(*[np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                     for name in _ARRAYS])
+
+
+def _indptr(sorted_rows, n_rows):
+    counts = np.bincount(sorted_rows, minlength=n_rows)
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def _saved_fingerprint(path):
+    try:
+        with open(os.path.join(path, 'manifest.json')) as file:
+            return json.load(file).get('source')
+    except FileNotFoundError:
+        return None
+
+
+def load_ratings_store(path_to_ratings=None, path=ratings_store_path):
+    """Return the process-wide ratings store, rebuilding it if stale.
+
+    Parameters
+    ----------
+    path_to_ratings : str, optional
+        Ratings the store is built from, `ratings.csv` of the data
+        directory by default.
+    path : str
+        Directory in which the store is saved.
+
+    Returns
+    -------
+    RatingsStore
+        Store matching the current contents of `path_to_ratings`. It is
+        rebuilt and reloaded once the file changes.
+
+    """
+    global _ratings_store
+    path_to_ratings = path_to_ratings or data_path('ratings.csv')
+    fingerprint = file_fingerprint(path_to_ratings)
+    key = (os.path.abspath(path_to_ratings), os.path.abspath(path), fingerprint)
+    with _ratings_store_lock:
+        if _ratings_store is None or _ratings_store[0] != key:
+            if _saved_fingerprint(path) != fingerprint:
+                with span('build ratings store') as stage:
+                    store = RatingsStore.from_csv(path_to_ratings)
+                    store.save(path, fingerprint)
+                    stage.items = store.n_ratings
+            with span('load ratings store') as stage:
+                store = RatingsStore.load(path)
+                stage.items = store.n_ratings
+            _ratings_store = (key, store)
+        return _ratings_store[1]
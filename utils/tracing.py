@@ -0,0 +1,326 @@
+"""
+
+    Per-stage timing and memory traces of recommendation requests.
+
+    Author: Explore Data Science Academy.
+
+    Description: A trace covers one request, e.g. one call of
+    `content_model`, and holds a span for every stage it went through:
+    reading a dataset, preprocessing, vectorising, similarity, the SVD
+    predictions and so on. A span records its duration, the number of
+    items it handled and how much memory it took:
+
+    - always, the growth of the process's peak resident memory, which is
+      non-zero only for stages that set a new high-water mark;
+    - with `enable(memory=True)`, the peak of Python and numpy allocations
+      above the level at the start of the span, from `tracemalloc`. This
+      slows allocation down noticeably, so it is off by default. The peak
+      is process-wide, so spans running at the same time share it.
+
+    Spans outside a trace, such as the app's data loading at start-up,
+    are recorded as traces of their own. Finished traces are kept in a
+    bounded in-memory buffer for the app's Diagnostics page, and can be
+    appended to a JSON lines file for offline analysis.
+
+    Tracing is off unless `RECOMMENDER_TRACING=1` is set or `enable` is
+    called. While it is off, `span` and `trace` return a shared no-op
+    context manager, so the hooks cost one function call each.
+
+"""
+# Script dependencies
+import os
+import json
+import time
+import threading
+import functools
+import contextvars
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+enabled = os.environ.get('RECOMMENDER_TRACING', '') not in ('', '0')
+trace_memory = False
+# Finished traces are also appended here as JSON lines when set
+trace_file = os.environ.get('RECOMMENDER_TRACE_FILE')
+
+max_traces = 500
+_traces = deque(maxlen=max_traces)
+_traces_lock = threading.Lock()
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_open_spans = contextvars.ContextVar('open_spans', default=())
+
+
+def enable(memory=False, path=None):
+    """Start recording traces.
+
+    Parameters
+    ----------
+    memory : bool
+        Also trace allocations with `tracemalloc`, see the module notes.
+    path : str, optional
+        JSON lines file every finished trace is appended to.
+
+    """
+    global enabled, trace_memory, trace_file
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not memory and trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    trace_memory = memory
+    trace_file = path or trace_file
+    enabled = True
+
+
+def disable():
+    """Stop recording traces. Those already recorded are kept."""
+    global enabled, trace_memory
+    if trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    trace_memory = False
+    enabled = False
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else 0.0
+
+
+class _NullSpan:
+    """Stands in for spans and traces while tracing is off."""
+
+    items = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+class Span:
+    """One stage of a request.
+
+    Attributes
+    ----------
+    name : str
+        Name of the stage.
+    items : int
+        Number of items the stage handled, e.g. rows read or movies
+        scored. May be set inside the `with` block.
+    seconds : float
+        Wall time of the stage.
+    rss_growth_mb : float
+        Growth of the peak resident memory of the process.
+    alloc_peak_mb : float
+        Peak of traced allocations above the level at the start, or None
+        without memory tracing.
+
+    """
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+        self.seconds = None
+        self.rss_growth_mb = None
+        self.alloc_peak_mb = None
+
+    def __enter__(self):
+        self._token = _open_spans.set(_open_spans.get() + (self,))
+        self._traced = trace_memory and tracemalloc.is_tracing()
+        if self._traced:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak so far belongs to the spans already open
+            for span in _open_spans.get()[:-1]:
+                if span._traced:
+                    span._peak = max(span._peak, peak)
+            tracemalloc.reset_peak()
+            self._base = self._peak = current
+        self._rss = _peak_rss_mb()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        self.rss_growth_mb = _peak_rss_mb() - self._rss
+        _open_spans.reset(self._token)
+        # Memory tracing may have been switched off meanwhile
+        if self._traced and tracemalloc.is_tracing():
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self.alloc_peak_mb = (self._peak - self._base) / 2 ** 20
+            for span in _open_spans.get():
+                if span._traced:
+                    span._peak = max(span._peak, self._peak)
+
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append(self)
+        else:
+            standalone = Trace(self.name)
+            standalone.seconds = self.seconds
+            standalone.spans.append(self)
+            _record(standalone)
+        return False
+
+    def to_dict(self):
+        return {'name': self.name, 'items': self.items, 'seconds': self.seconds,
+                'rss_growth_mb': self.rss_growth_mb, 'alloc_peak_mb': self.alloc_peak_mb}
+
+
+class Trace:
+    """The spans of one request, in the order they finished.
+
+    Attributes
+    ----------
+    name : str
+        What was requested, e.g. 'content' or 'collab'.
+    attributes : dict
+        Details of the request, such as the number of favourites.
+    started : float
+        Unix time at which the request started.
+    seconds : float
+        Wall time of the whole request.
+    error : str
+        Name of the exception the request raised, if any.
+    spans : list (Span)
+
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self.seconds = None
+        self.error = None
+        self.spans = []
+
+    def __enter__(self):
+        self._token = _current_trace.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        self.error = exc_type.__name__ if exc_type is not None else None
+        _current_trace.reset(self._token)
+        _record(self)
+        return False
+
+    def to_dict(self):
+        return {'name': self.name, 'started': self.started, 'seconds': self.seconds,
+                'error': self.error, 'attributes': self.attributes,
+                'spans': [span.to_dict() for span in self.spans]}
+
+
+def span(name, items=None):
+    """Context manager recording one stage, a no-op while tracing is off."""
+    if not enabled:
+        return _NULL
+    return Span(name, items)
+
+
+def trace(name, **attributes):
+    """Context manager grouping the spans of one request."""
+    if not enabled:
+        return _NULL
+    return Trace(name, **attributes)
+
+
+def traced(name):
+    """Decorator recording every call of a function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _record(finished):
+    record = finished.to_dict()
+    with _traces_lock:
+        _traces.append(record)
+        if trace_file:
+            with open(trace_file, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+
+def recent_traces(n=None):
+    """The last `n` finished traces as dictionaries, newest first."""
+    with _traces_lock:
+        traces = list(_traces)
+    return traces[::-1][:n]
+
+
+def clear():
+    """Forget the recorded traces."""
+    with _traces_lock:
+        _traces.clear()
+
+
+def to_jsonl(traces=None):
+    """The recorded traces as JSON lines, oldest first."""
+    traces = recent_traces()[::-1] if traces is None else traces
+    return ''.join(json.dumps(record) + '\n' for record in traces)
+
+
+def export_jsonl(path):
+    """Write the recorded traces to a JSON lines file."""
+    with open(path, 'w') as file:
+        file.write(to_jsonl())
+
+
+def summary(traces=None):
+    """Percentiles of the duration of every trace and stage.
+
+    Parameters
+    ----------
+    traces : list (dict), optional
+        Traces to summarise, the recorded ones by default.
+
+    Returns
+    -------
+    list (dict)
+        One row per trace name and stage, with the stage '' covering the
+        whole trace: the count, the p50/p95/p99 durations in
+        milliseconds, the mean number of items and the largest memory
+        growth and allocation peak in MB.
+
+    """
+    traces = recent_traces() if traces is None else traces
+    groups = {}
+    for record in traces:
+        groups.setdefault((record['name'], ''), []).append(
+            {'seconds': record['seconds'], 'items': None, 'rss_growth_mb': None,
+             'alloc_peak_mb': None})
+        for stage in record['spans']:
+            groups.setdefault((record['name'], stage['name']), []).append(stage)
+
+    rows = []
+    for (name, stage), spans in groups.items():
+        ms = np.array([s['seconds'] for s in spans]) * 1000
+        items = [s['items'] for s in spans if s['items'] is not None]
+        rss = [s['rss_growth_mb'] for s in spans if s['rss_growth_mb'] is not None]
+        alloc = [s['alloc_peak_mb'] for s in spans if s['alloc_peak_mb'] is not None]
+        p50, p95, p99 = (float(p) for p in np.percentile(ms, [50, 95, 99]))
+        rows.append({'trace': name, 'stage': stage, 'count': len(spans),
+                     'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+                     'mean_items': float(np.mean(items)) if items else None,
+                     'max_rss_growth_mb': max(rss) if rss else None,
+                     'max_alloc_peak_mb': max(alloc) if alloc else None})
+    return rows